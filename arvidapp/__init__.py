@@ -23,13 +23,16 @@ from builtins import range
 from builtins import object
 import clang.cindex
 import ctypes
-import configparser
+import os
 import os.path
 import json
-import itertools
-from collections import defaultdict, MutableSet
+import hashlib
+from collections import defaultdict, OrderedDict
+try:
+    from collections.abc import MutableSet
+except ImportError:  # Python 2
+    from collections import MutableSet
 from functools import wraps
-import re
 import atexit
 
 __author__ = 'Dmitri Rubinstein'
@@ -38,10 +41,27 @@ PARAM_BEGIN_PREFIX = "arvida-"
 PARAM_END = "arvida-eop"
 PARAM_VALUE_PREFIX = "arvida-param-"
 
+# Frequently compared kinds, bound once to avoid attribute lookups in AST walks
+_K_CXX_METHOD = clang.cindex.CursorKind.CXX_METHOD
+_K_FIELD_DECL = clang.cindex.CursorKind.FIELD_DECL
+_K_STRUCT_DECL = clang.cindex.CursorKind.STRUCT_DECL
+_K_CLASS_DECL = clang.cindex.CursorKind.CLASS_DECL
+_K_CLASS_TEMPLATE = clang.cindex.CursorKind.CLASS_TEMPLATE
+_K_CXX_BASE_SPECIFIER = clang.cindex.CursorKind.CXX_BASE_SPECIFIER
+_K_TEMPLATE_TYPE_PARAMETER = clang.cindex.CursorKind.TEMPLATE_TYPE_PARAMETER
+_K_NAMESPACE = clang.cindex.CursorKind.NAMESPACE
+_K_FUNCTION_DECL = clang.cindex.CursorKind.FUNCTION_DECL
+_K_CALL_EXPR = clang.cindex.CursorKind.CALL_EXPR
+_K_ANNOTATE_ATTR = clang.cindex.CursorKind.ANNOTATE_ATTR
+_PUBLIC = clang.cindex.AccessSpecifier.PUBLIC
+
+_UINT32_MASK = 0xFFFFFFFF
+_UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
 
 def hash_value_ptr(pval):
-    pval = pval if pval is not None else 0
-    return (int(ctypes.c_uint(pval).value) >> 4) ^ (int(ctypes.c_uint(pval).value) >> 9)
+    pval = (pval if pval is not None else 0) & _UINT32_MASK
+    return (pval >> 4) ^ (pval >> 9)
 
 
 def hash_value_uint(val):
@@ -49,16 +69,17 @@ def hash_value_uint(val):
 
 
 def hash_value_mix(a, b):
-    key = ctypes.c_uint64((ctypes.c_uint64(a).value << 32 | ctypes.c_uint64(b).value))
-    key.value += ~(key.value << 32)
-    key.value ^= (key.value >> 22)
-    key.value += ~(key.value << 13)
-    key.value ^= (key.value >> 8)
-    key.value += (key.value << 3)
-    key.value ^= (key.value >> 15)
-    key.value += ~(key.value << 27)
-    key.value ^= (key.value >> 31)
-    return ctypes.c_uint(key.value).value
+    # 64-bit integer mix, Python ints are masked to emulate unsigned overflow
+    key = ((a << 32) | (b & _UINT64_MASK)) & _UINT64_MASK
+    key = (key + (~(key << 32) & _UINT64_MASK)) & _UINT64_MASK
+    key ^= (key >> 22)
+    key = (key + (~(key << 13) & _UINT64_MASK)) & _UINT64_MASK
+    key ^= (key >> 8)
+    key = (key + (key << 3)) & _UINT64_MASK
+    key ^= (key >> 15)
+    key = (key + (~(key << 27) & _UINT64_MASK)) & _UINT64_MASK
+    key ^= (key >> 31)
+    return key & _UINT32_MASK
 
 
 def patch_cindex():
@@ -102,52 +123,36 @@ patch_cindex()
 
 
 class OrderedSet(MutableSet):
-    # noinspection PyMethodFirstArgAssignment
     def __init__(self, iterable=None):
-        self.end = end = []
-        end += [None, end, end]  # sentinel node for doubly linked list
-        self.map = {}  # key --> [key, prev, next]
+        self._map = OrderedDict()  # key --> None
         if iterable is not None:
             self |= iterable
 
     def __len__(self):
-        return len(self.map)
+        return len(self._map)
 
     def __contains__(self, key):
-        return key in self.map
+        return key in self._map
 
     def add(self, key):
-        if key not in self.map:
-            end = self.end
-            curr = end[1]
-            curr[2] = end[1] = self.map[key] = [key, curr, end]
+        self._map.setdefault(key, None)
 
     def discard(self, key):
-        if key in self.map:
-            key, prev, next = self.map.pop(key)
-            prev[2] = next
-            next[1] = prev
+        self._map.pop(key, None)
+
+    def clear(self):
+        self._map.clear()
 
     def __iter__(self):
-        end = self.end
-        curr = end[2]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[2]
+        return iter(self._map)
 
     def __reversed__(self):
-        end = self.end
-        curr = end[1]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[1]
+        return reversed(self._map)
 
     def pop(self, last=True):
         if not self:
             raise KeyError('set is empty')
-        key = self.end[1][0] if last else self.end[2][0]
-        self.discard(key)
-        return key
+        return self._map.popitem(last=last)[0]
 
     def __repr__(self):
         if not self:
@@ -166,52 +171,112 @@ def first(iterable, default=None):
     return default
 
 
-TOKEN_SCANNER = re.compile(r'''
-  (\s+) |                      # whitespace
-  (0[xX][0-9A-Fa-f]+) |        # hexadecimal integer literals
-  (\d+) |                      # integer literals
-  ([<>,]) |                    # punctuation
-  ((?:::|[^<>:,])*)            # rest
-''', re.DOTALL | re.VERBOSE)
+_SPELLING_CACHES = []
+
+
+def spelling_cached(maxsize=8192):
+    """Decorator for functions of a single spelling string, results must be treated as read-only"""
+
+    def decorator(f):
+        cache = {}
+        _SPELLING_CACHES.append(cache)
+
+        @wraps(f)
+        def wrapper(spelling):
+            try:
+                return cache[spelling]
+            except KeyError:
+                pass
+            value = f(spelling)
+            if len(cache) >= maxsize:
+                cache.clear()
+            cache[spelling] = value
+            return value
+
+        return wrapper
+
+    return decorator
+
 
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+_DEC_DIGITS = frozenset('0123456789')
+_PUNCTUATION = frozenset('<>,')
+_NAME_STOP_CHARS = frozenset('<>:,')
 
+
+@spelling_cached()
 def tokenize_type_spelling(type_str):
+    """Split type spelling into integer literals, '<', '>', ',' and names (which may contain '::')"""
     res = []
-    for match in re.finditer(TOKEN_SCANNER, type_str):
-        space, hexnum, intnum, punct, rest = match.groups()
-        if space:
-            continue
-        elif hexnum:
-            res.append(int(hexnum))
-        elif intnum:
-            res.append(int(intnum))
-        elif punct:
-            res.append(punct)
-        elif rest:
-            res.append(rest)
+    res_append = res.append
+    n = len(type_str)
+    i = 0
+    while i < n:
+        c = type_str[i]
+        if c.isspace():
+            i += 1
+            while i < n and type_str[i].isspace():
+                i += 1
+        elif c == '0' and i + 2 < n and type_str[i + 1] in 'xX' and type_str[i + 2] in _HEX_DIGITS:
+            j = i + 3
+            while j < n and type_str[j] in _HEX_DIGITS:
+                j += 1
+            res_append(int(type_str[i + 2:j], 16))
+            i = j
+        elif c in _DEC_DIGITS:
+            j = i + 1
+            while j < n and type_str[j] in _DEC_DIGITS:
+                j += 1
+            res_append(int(type_str[i:j]))
+            i = j
+        elif c in _PUNCTUATION:
+            res_append(c)
+            i += 1
+        else:
+            j = i
+            while j < n:
+                if type_str[j] not in _NAME_STOP_CHARS:
+                    j += 1
+                elif type_str.startswith('::', j):
+                    j += 2
+                else:
+                    break
+            if j == i:
+                # single ':' is not a part of any token
+                j += 1
+            else:
+                res_append(type_str[i:j])
+            i = j
     return res
 
 
 class TypeSpellingInfo(object):
+    __slots__ = ('name', 'template_arguments', '_str')
+
     def __init__(self, name, template_arguments=None):
         self.name = name
         self.template_arguments = template_arguments
+        self._str = None
 
     def add_argument(self, tsi):
+        self._str = None
         if self.template_arguments is None:
             self.template_arguments = [tsi]
         else:
             self.template_arguments.append(tsi)
 
     def __str__(self):
-        res = str(self.name)
-        if self.template_arguments is not None:
-            res += '<' + ', '.join([str(i) for i in self.template_arguments])
-            if res.endswith('>'):
-                res += ' '
-            res += '>'
-
-        return res
+        if self._str is None:
+            parts = [str(self.name)]
+            if self.template_arguments is not None:
+                args = ', '.join([str(i) for i in self.template_arguments])
+                parts.append('<')
+                parts.append(args)
+                if args.endswith('>'):
+                    parts.append(' ')
+                parts.append('>')
+            self._str = ''.join(parts)
+        return self._str
 
     def __repr__(self):
         return 'TypeSpellingInfo({!r}, {})'.format(
@@ -220,6 +285,22 @@ class TypeSpellingInfo(object):
                 [repr(i) for i in self.template_arguments]) + ']' if self.template_arguments is not None else None)
 
 
+_TSI_LEAF_POOL = {}  # name --> TypeSpellingInfo without template arguments
+_TSI_LEAF_POOL_MAXSIZE = 16384
+_SPELLING_CACHES.append(_TSI_LEAF_POOL)
+
+
+def leaf_type_spelling_info(name):
+    """Returns shared TypeSpellingInfo for name without template arguments, it must not be modified"""
+    tsi = _TSI_LEAF_POOL.get(name)
+    if tsi is None:
+        if len(_TSI_LEAF_POOL) >= _TSI_LEAF_POOL_MAXSIZE:
+            _TSI_LEAF_POOL.clear()
+        tsi = _TSI_LEAF_POOL[name] = TypeSpellingInfo(name)
+    return tsi
+
+
+@spelling_cached()
 def analyze_type_spelling(type_str):
     tokens = tokenize_type_spelling(type_str)
     if not tokens:
@@ -249,10 +330,13 @@ def analyze_type_spelling(type_str):
         else:
             assert tsi is not None
             token = tokens[i]
-            if isinstance(token, int) or isinstance(token, str):
+            # Names become TypeSpellingInfo, so that a following '<' can attach template arguments to them
+            if isinstance(token, int):
                 tsi_arg = token
-            else:
+            elif i + 1 < tklen and tokens[i + 1] == '<':
                 tsi_arg = TypeSpellingInfo(token)
+            else:
+                tsi_arg = leaf_type_spelling_info(token)
             tsi.add_argument(tsi_arg)
         i += 1
 
@@ -261,11 +345,37 @@ def analyze_type_spelling(type_str):
     return tsi
 
 
+_INVALID_CURSOR_KINDS = frozenset((
+    clang.cindex.CursorKind.INVALID_FILE,
+    clang.cindex.CursorKind.NO_DECL_FOUND,
+    clang.cindex.CursorKind.NOT_IMPLEMENTED,
+    clang.cindex.CursorKind.INVALID_CODE))
+
+_NAMED_SCOPE_KINDS = frozenset((
+    clang.cindex.CursorKind.NAMESPACE,
+    clang.cindex.CursorKind.STRUCT_DECL,
+    clang.cindex.CursorKind.UNION_DECL,
+    clang.cindex.CursorKind.ENUM_DECL,
+    clang.cindex.CursorKind.CLASS_DECL,
+    clang.cindex.CursorKind.CLASS_TEMPLATE,
+    clang.cindex.CursorKind.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION))
+
+_TYPE_DECL_KINDS = frozenset((
+    clang.cindex.CursorKind.STRUCT_DECL,
+    clang.cindex.CursorKind.UNION_DECL,
+    clang.cindex.CursorKind.ENUM_DECL,
+    clang.cindex.CursorKind.CLASS_DECL,
+    clang.cindex.CursorKind.CLASS_TEMPLATE,
+    clang.cindex.CursorKind.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION))
+
+_RECORD_DECL_KINDS = frozenset((
+    clang.cindex.CursorKind.STRUCT_DECL,
+    clang.cindex.CursorKind.CLASS_DECL,
+    clang.cindex.CursorKind.UNION_DECL))
+
+
 def is_valid_cursor(cursor):
-    return cursor and cursor.kind not in (clang.cindex.CursorKind.INVALID_FILE,
-                                          clang.cindex.CursorKind.NO_DECL_FOUND,
-                                          clang.cindex.CursorKind.NOT_IMPLEMENTED,
-                                          clang.cindex.CursorKind.INVALID_CODE)
+    return cursor and cursor.kind not in _INVALID_CURSOR_KINDS
 
 
 def is_valid_type(type):
@@ -273,36 +383,19 @@ def is_valid_type(type):
 
 
 def is_named_scope(cursor):
-    return cursor.kind in (
-        clang.cindex.CursorKind.NAMESPACE,
-        clang.cindex.CursorKind.STRUCT_DECL,
-        clang.cindex.CursorKind.UNION_DECL,
-        clang.cindex.CursorKind.ENUM_DECL,
-        clang.cindex.CursorKind.CLASS_DECL,
-        clang.cindex.CursorKind.CLASS_TEMPLATE,
-        clang.cindex.CursorKind.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION,
-    )
+    return cursor.kind in _NAMED_SCOPE_KINDS
 
 
 def is_type(cursor):
-    return (cursor.type.kind != clang.cindex.TypeKind.INVALID) or cursor.kind in (
-        clang.cindex.CursorKind.STRUCT_DECL,
-        clang.cindex.CursorKind.UNION_DECL,
-        clang.cindex.CursorKind.ENUM_DECL,
-        clang.cindex.CursorKind.CLASS_DECL,
-        clang.cindex.CursorKind.CLASS_TEMPLATE,
-        clang.cindex.CursorKind.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION)
+    return (cursor.type.kind != clang.cindex.TypeKind.INVALID) or cursor.kind in _TYPE_DECL_KINDS
 
 
 def is_template(cursor):
-    return cursor.kind in [clang.cindex.CursorKind.CLASS_TEMPLATE]
+    return cursor.kind == _K_CLASS_TEMPLATE
 
 
 def is_specialized_template(cursor):
-    return cursor.kind in [
-        clang.cindex.CursorKind.STRUCT_DECL,
-        clang.cindex.CursorKind.CLASS_DECL,
-        clang.cindex.CursorKind.UNION_DECL] and cursor.type.get_num_template_arguments() > 0
+    return cursor.kind in _RECORD_DECL_KINDS and cursor.type.get_num_template_arguments() > 0
 
 
 # def type_spelling(cursor):
@@ -321,29 +414,15 @@ def type_spelling(cursor):
     return name
 
 
-def semantic_parents(cursor):
-    import collections
-
-    p = collections.deque()
-    c = cursor.semantic_parent
-    while c and is_named_scope(c):
-        name = type_spelling(c)
-        p.appendleft(name)
-        c = c.semantic_parent
-    return list(p)
-
-
-_CURSOR_CACHE = {}
-
-
-class CacheEntry(object):
-    pass
+_CURSOR_CACHE = defaultdict(dict)  # cursor --> {key: value}
 
 
 # Prevent gc problems by deleting cursor cache before clang.cindex configuration is deleted
 @atexit.register
 def clear_cache():
     _CURSOR_CACHE.clear()
+    for cache in _SPELLING_CACHES:
+        cache.clear()
 
 
 def cursor_cached(f):
@@ -355,7 +434,6 @@ def cursor_cached(f):
 
     @wraps(f)
     def wrapper(*args, **kwargs):
-        global _CURSOR_CACHE
         cursor = None
         centry = None
         if len(args) and args[0] is not None:
@@ -363,183 +441,269 @@ def cursor_cached(f):
         if not cursor:
             cursor = kwargs.get('cursor', None)
         if cursor:
-            centry = _CURSOR_CACHE.get(cursor)
-            if not centry:
-                centry = CacheEntry()
-                _CURSOR_CACHE[cursor] = centry
-            else:
-                value = getattr(centry, key, None)
-                if value is not None:
-                    return value
+            centry = _CURSOR_CACHE[cursor]
+            try:
+                return centry[key]
+            except KeyError:
+                pass
         value = f(*args, **kwargs)
-        if centry:
-            setattr(centry, key, value)
+        if centry is not None:
+            centry[key] = value
         return value
 
     return wrapper
 
 
 @cursor_cached
-def get_full_name(cursor):
-    if cursor.kind in (
-            clang.cindex.CursorKind.TRANSLATION_UNIT,
-            clang.cindex.CursorKind.UNEXPOSED_ATTR,
-            clang.cindex.CursorKind.PURE_ATTR,
-            clang.cindex.CursorKind.CONST_ATTR,
-            clang.cindex.CursorKind.UNARY_OPERATOR,
-            clang.cindex.CursorKind.BINARY_OPERATOR,
-            clang.cindex.CursorKind.CONDITIONAL_OPERATOR,
-            clang.cindex.CursorKind.COMPOUND_ASSIGNMENT_OPERATOR,
-            clang.cindex.CursorKind.CALL_EXPR,
-            clang.cindex.CursorKind.DECL_REF_EXPR,
-            clang.cindex.CursorKind.UNEXPOSED_EXPR,
-            clang.cindex.CursorKind.ARRAY_SUBSCRIPT_EXPR,
-            clang.cindex.CursorKind.CXX_THIS_EXPR,
-            clang.cindex.CursorKind.MEMBER_REF_EXPR,
-            clang.cindex.CursorKind.CXX_UNARY_EXPR,
-            clang.cindex.CursorKind.CXX_STATIC_CAST_EXPR,
-            clang.cindex.CursorKind.CXX_NEW_EXPR,
-            clang.cindex.CursorKind.PACK_EXPANSION_EXPR,
-            clang.cindex.CursorKind.PAREN_EXPR,
-            clang.cindex.CursorKind.CSTYLE_CAST_EXPR,
-            clang.cindex.CursorKind.CXX_REINTERPRET_CAST_EXPR,
-            clang.cindex.CursorKind.CXX_CONST_CAST_EXPR,
-            clang.cindex.CursorKind.CXX_FUNCTIONAL_CAST_EXPR,
-            clang.cindex.CursorKind.CXX_THROW_EXPR,
-            clang.cindex.CursorKind.CXX_DYNAMIC_CAST_EXPR,
-            clang.cindex.CursorKind.GNU_NULL_EXPR,
-            clang.cindex.CursorKind.SIZE_OF_PACK_EXPR,
-            clang.cindex.CursorKind.INIT_LIST_EXPR,
-            clang.cindex.CursorKind.CXX_DELETE_EXPR,
-            clang.cindex.CursorKind.CXX_TYPEID_EXPR,
-            clang.cindex.CursorKind.COMPOUND_STMT,
-            clang.cindex.CursorKind.RETURN_STMT,
-            clang.cindex.CursorKind.DECL_STMT,
-            clang.cindex.CursorKind.FOR_STMT,
-            clang.cindex.CursorKind.WHILE_STMT,
-            clang.cindex.CursorKind.DO_STMT,
-            clang.cindex.CursorKind.NULL_STMT,
-            clang.cindex.CursorKind.IF_STMT,
-            clang.cindex.CursorKind.BREAK_STMT,
-            clang.cindex.CursorKind.CXX_TRY_STMT,
-            clang.cindex.CursorKind.CXX_CATCH_STMT,
-            clang.cindex.CursorKind.SWITCH_STMT,
-            clang.cindex.CursorKind.CASE_STMT,
-            clang.cindex.CursorKind.DEFAULT_STMT,
-            clang.cindex.CursorKind.ASM_STMT,
-            # clang.cindex.CursorKind.UNEXPOSED_DECL,
-            clang.cindex.CursorKind.VAR_DECL,
-            clang.cindex.CursorKind.CXX_ACCESS_SPEC_DECL,
-            clang.cindex.CursorKind.USING_DIRECTIVE):
-        return None
-    if cursor.kind == clang.cindex.CursorKind.CXX_NULL_PTR_LITERAL_EXPR:
-        return '::std::nullptr_t'
+def semantic_parents(cursor):
+    # Reuse the cached chain of the parent, so that every scope is walked only once
+    c = cursor.semantic_parent
+    if c and is_named_scope(c):
+        return semantic_parents(c) + [type_spelling(c)]
+    return []
+
+
+@cursor_cached
+def get_children(cursor):
+    """Returns tuple of cursor children, they are fetched from libclang only once per cursor"""
+    return tuple(cursor.get_children())
+
+
+_FULL_NAME_SKIP_KINDS = frozenset((
+    clang.cindex.CursorKind.TRANSLATION_UNIT,
+    clang.cindex.CursorKind.UNEXPOSED_ATTR,
+    clang.cindex.CursorKind.PURE_ATTR,
+    clang.cindex.CursorKind.CONST_ATTR,
+    clang.cindex.CursorKind.UNARY_OPERATOR,
+    clang.cindex.CursorKind.BINARY_OPERATOR,
+    clang.cindex.CursorKind.CONDITIONAL_OPERATOR,
+    clang.cindex.CursorKind.COMPOUND_ASSIGNMENT_OPERATOR,
+    clang.cindex.CursorKind.CALL_EXPR,
+    clang.cindex.CursorKind.DECL_REF_EXPR,
+    clang.cindex.CursorKind.UNEXPOSED_EXPR,
+    clang.cindex.CursorKind.ARRAY_SUBSCRIPT_EXPR,
+    clang.cindex.CursorKind.CXX_THIS_EXPR,
+    clang.cindex.CursorKind.MEMBER_REF_EXPR,
+    clang.cindex.CursorKind.CXX_UNARY_EXPR,
+    clang.cindex.CursorKind.CXX_STATIC_CAST_EXPR,
+    clang.cindex.CursorKind.CXX_NEW_EXPR,
+    clang.cindex.CursorKind.PACK_EXPANSION_EXPR,
+    clang.cindex.CursorKind.PAREN_EXPR,
+    clang.cindex.CursorKind.CSTYLE_CAST_EXPR,
+    clang.cindex.CursorKind.CXX_REINTERPRET_CAST_EXPR,
+    clang.cindex.CursorKind.CXX_CONST_CAST_EXPR,
+    clang.cindex.CursorKind.CXX_FUNCTIONAL_CAST_EXPR,
+    clang.cindex.CursorKind.CXX_THROW_EXPR,
+    clang.cindex.CursorKind.CXX_DYNAMIC_CAST_EXPR,
+    clang.cindex.CursorKind.GNU_NULL_EXPR,
+    clang.cindex.CursorKind.SIZE_OF_PACK_EXPR,
+    clang.cindex.CursorKind.INIT_LIST_EXPR,
+    clang.cindex.CursorKind.CXX_DELETE_EXPR,
+    clang.cindex.CursorKind.CXX_TYPEID_EXPR,
+    clang.cindex.CursorKind.COMPOUND_STMT,
+    clang.cindex.CursorKind.RETURN_STMT,
+    clang.cindex.CursorKind.DECL_STMT,
+    clang.cindex.CursorKind.FOR_STMT,
+    clang.cindex.CursorKind.WHILE_STMT,
+    clang.cindex.CursorKind.DO_STMT,
+    clang.cindex.CursorKind.NULL_STMT,
+    clang.cindex.CursorKind.IF_STMT,
+    clang.cindex.CursorKind.BREAK_STMT,
+    clang.cindex.CursorKind.CXX_TRY_STMT,
+    clang.cindex.CursorKind.CXX_CATCH_STMT,
+    clang.cindex.CursorKind.SWITCH_STMT,
+    clang.cindex.CursorKind.CASE_STMT,
+    clang.cindex.CursorKind.DEFAULT_STMT,
+    clang.cindex.CursorKind.ASM_STMT,
+    # clang.cindex.CursorKind.UNEXPOSED_DECL,
+    clang.cindex.CursorKind.VAR_DECL,
+    clang.cindex.CursorKind.CXX_ACCESS_SPEC_DECL,
+    clang.cindex.CursorKind.USING_DIRECTIVE))
+
+_FULL_NAME_TYPE_SPELLING_KINDS = frozenset((
+    clang.cindex.CursorKind.STRING_LITERAL,
+    clang.cindex.CursorKind.CHARACTER_LITERAL,
+    clang.cindex.CursorKind.INTEGER_LITERAL,
+    clang.cindex.CursorKind.FLOATING_LITERAL,
+    clang.cindex.CursorKind.PARM_DECL,
+    clang.cindex.CursorKind.CXX_BOOL_LITERAL_EXPR,
+    clang.cindex.CursorKind.TEMPLATE_TYPE_PARAMETER))
+
+
+def _full_name_none(cursor):
+    return None
+
+
+def _full_name_nullptr(cursor):
+    return '::std::nullptr_t'
+
+
+def _full_name_type_spelling(cursor):
+    return cursor.type.spelling
+
+
+def _full_name_default(cursor):
     if cursor.kind.is_reference() and cursor.referenced != cursor:
         # in [
         # clang.cindex.CursorKind.TYPE_REF,
         # clang.cindex.CursorKind.NAMESPACE_REF,
         # clang.cindex.CursorKind.TEMPLATE_REF,
         # clang.cindex.CursorKind.CXX_BASE_SPECIFIER]:
-        name = get_full_name(cursor.referenced)
-    elif cursor.kind in (
-            clang.cindex.CursorKind.STRING_LITERAL,
-            clang.cindex.CursorKind.CHARACTER_LITERAL,
-            clang.cindex.CursorKind.INTEGER_LITERAL,
-            clang.cindex.CursorKind.FLOATING_LITERAL,
-            clang.cindex.CursorKind.PARM_DECL,
-            clang.cindex.CursorKind.CXX_BOOL_LITERAL_EXPR,
-            clang.cindex.CursorKind.TEMPLATE_TYPE_PARAMETER):
-        name = cursor.type.spelling
+        return get_full_name(cursor.referenced)
+
+    parents = semantic_parents(cursor)
+    own_name = cursor.spelling or '(anonymous)'
+    # check for possible template instantiation
+    # tokens = itertools.ifilter(lambda x: x.kind != clang.cindex.TokenKind.COMMENT, cursor.get_tokens())
+    # if tokens:
+    #     l = [k.spelling for k in itertools.islice(tokens, 3)]
+    #     if l == ["template", "<", ">"]:
+    #         x = next(tokens, None)
+    #         if x and x.spelling in ['struct', 'class']:
+    #             if next(tokens, None) is not None: # ignore class name
+    #                 x = next(tokens, None)
+    #                 if x and x.spelling == '<':
+    #                     depth = 1
+    #                     own_name += '<'
+    #                     lastkind = clang.cindex.TokenKind.PUNCTUATION
+    #                     for x in tokens:
+    #                         if (lastkind in (clang.cindex.TokenKind.IDENTIFIER, clang.cindex.TokenKind.KEYWORD)
+    #                             and
+    #                             x.kind in (clang.cindex.TokenKind.IDENTIFIER, clang.cindex.TokenKind.KEYWORD)):
+    #                             own_name += ' '
+    #                         own_name += x.spelling
+    #                         lastkind = x.kind
+    #                         if x.spelling == '>':
+    #                             depth -= 1
+    #                             if depth == 0:
+    #                                 break
+    #                         elif x.spelling == '<':
+    #                             depth += 1
+    if cursor.kind in (
+            clang.cindex.CursorKind.CONSTRUCTOR,):
+        name = "::".join(parents + [own_name])
+    elif "anonymous" in own_name:  # this usually means anonymous
+        name = own_name
     else:
-        parents = semantic_parents(cursor)
-        own_name = cursor.spelling or '(anonymous)'
-        # check for possible template instantiation
-        # tokens = itertools.ifilter(lambda x: x.kind != clang.cindex.TokenKind.COMMENT, cursor.get_tokens())
-        # if tokens:
-        #     l = [k.spelling for k in itertools.islice(tokens, 3)]
-        #     if l == ["template", "<", ">"]:
-        #         x = next(tokens, None)
-        #         if x and x.spelling in ['struct', 'class']:
-        #             if next(tokens, None) is not None: # ignore class name
-        #                 x = next(tokens, None)
-        #                 if x and x.spelling == '<':
-        #                     depth = 1
-        #                     own_name += '<'
-        #                     lastkind = clang.cindex.TokenKind.PUNCTUATION
-        #                     for x in tokens:
-        #                         if (lastkind in (clang.cindex.TokenKind.IDENTIFIER, clang.cindex.TokenKind.KEYWORD)
-        #                             and
-        #                             x.kind in (clang.cindex.TokenKind.IDENTIFIER, clang.cindex.TokenKind.KEYWORD)):
-        #                             own_name += ' '
-        #                         own_name += x.spelling
-        #                         lastkind = x.kind
-        #                         if x.spelling == '>':
-        #                             depth -= 1
-        #                             if depth == 0:
-        #                                 break
-        #                         elif x.spelling == '<':
-        #                             depth += 1
-        if cursor.kind in (
-                clang.cindex.CursorKind.CONSTRUCTOR,):
-            name = "::".join(parents + [own_name])
-        elif "anonymous" in own_name:  # this usually means anonymous
+        name = "::".join(parents + [own_name])
+        if not name:
             name = own_name
-        else:
-            name = "::".join(parents + [own_name])
-            if not name:
-                name = own_name
-        if name and not name.startswith('::'):
-            name = '::' + name
+    if name and not name.startswith('::'):
+        name = '::' + name
     return name
 
 
+# CursorKind value --> full name handler, kinds without entry are handled by _full_name_default
+_FULL_NAME_DISPATCH = dict((k.value, _full_name_none) for k in _FULL_NAME_SKIP_KINDS)
+_FULL_NAME_DISPATCH.update((k.value, _full_name_type_spelling) for k in _FULL_NAME_TYPE_SPELLING_KINDS)
+_FULL_NAME_DISPATCH[clang.cindex.CursorKind.CXX_NULL_PTR_LITERAL_EXPR.value] = _full_name_nullptr
+
+
 @cursor_cached
+def get_full_name(cursor):
+    return _FULL_NAME_DISPATCH.get(cursor.kind.value, _full_name_default)(cursor)
+
+
 def get_full_specialized_name(cursor, include_default_template_args=False):
+    if not is_specialized_template(cursor):
+        return get_full_name(cursor)
+
+    centry = _CURSOR_CACHE[cursor]
+    key = ('full_specialized_name', include_default_template_args)
+    try:
+        return centry[key]
+    except KeyError:
+        pass
+
     name = get_full_name(cursor)
-    if is_specialized_template(cursor):
-        # Analyze type spelling for cases which are not directly supported
-        # by libclang API
-        tsi = analyze_type_spelling(cursor.type.spelling)
-        targs = []
-        for i in range(cursor.type.get_num_template_arguments()):
-            # FIXME Current libclang API does not provide information about default arguments
+    # Analyze type spelling for cases which are not directly supported
+    # by libclang API
+    tsi = analyze_type_spelling(cursor.type.spelling)
+    targs = []
+    for i in range(cursor.type.get_num_template_arguments()):
+        # FIXME Current libclang API does not provide information about default arguments
+        # Use parsed information
+        if not include_default_template_args and i >= len(tsi.template_arguments):
+            break
+        targ = cursor.type.get_template_argument_type(i)
+        if targ.kind == clang.cindex.TypeKind.INVALID:
+            # FIXME Current libclang API does not support non-type template arguments
             # Use parsed information
-            if not include_default_template_args and i >= len(tsi.template_arguments):
-                break
-            targ = cursor.type.get_template_argument_type(i)
-            if targ.kind == clang.cindex.TypeKind.INVALID:
-                # FIXME Current libclang API does not support non-type template arguments
-                # Use parsed information
-                if i < len(tsi.template_arguments):
-                    fsn = str(tsi.template_arguments[i])
-                else:
-                    fsn = '?'
+            if i < len(tsi.template_arguments):
+                fsn = str(tsi.template_arguments[i])
             else:
-                decl = targ.get_declaration()
-                if decl.kind == clang.cindex.CursorKind.NO_DECL_FOUND:
-                    # primitive type
-                    fsn = targ.spelling
-                else:
-                    fsn = get_full_specialized_name(decl, include_default_template_args)
-            targs.append(fsn)
-        name += '<' + (', '.join(targs))
-        if name.endswith('>'):
-            name += ' >'
+                fsn = '?'
         else:
-            name += '>'
+            decl = targ.get_declaration()
+            if decl.kind == clang.cindex.CursorKind.NO_DECL_FOUND:
+                # primitive type
+                fsn = targ.spelling
+            else:
+                fsn = get_full_specialized_name(decl, include_default_template_args)
+        targs.append(fsn)
+    name += '<' + (', '.join(targs))
+    if name.endswith('>'):
+        name += ' >'
+    else:
+        name += '>'
+    centry[key] = name
     return name
 
 
+def walk_preorder(cursor):
+    """
+    Same as clang.cindex.Cursor.walk_preorder but uses an explicit stack instead of
+    nested generators, so yielding a cursor does not cost one frame per tree level
+    """
+    stack = [cursor]
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+        c = pop()
+        yield c
+        children = list(c.get_children())
+        children.reverse()
+        extend(children)
+
+
 def find_cursor(cursor, full_specialized_type_name):
     if isinstance(cursor, clang.cindex.TranslationUnit):
         cursor = cursor.cursor
-    for c in cursor.walk_preorder():
+    for c in walk_preorder(cursor):
         if get_full_specialized_name(c) == full_specialized_type_name:
             return c
     return None
 
 
+_DEREFERENCABLE_TYPE_KINDS = frozenset((
+    clang.cindex.TypeKind.LVALUEREFERENCE,
+    clang.cindex.TypeKind.RVALUEREFERENCE,
+    clang.cindex.TypeKind.POINTER))
+
+_REFERENCE_TYPE_KINDS = frozenset((
+    clang.cindex.TypeKind.LVALUEREFERENCE,
+    clang.cindex.TypeKind.RVALUEREFERENCE))
+
+_FUNCTION_CURSOR_KINDS = frozenset((
+    clang.cindex.CursorKind.CXX_METHOD,
+    clang.cindex.CursorKind.FUNCTION_DECL))
+
+
+# Suffixes of dereferencable types without declaration
+_DEREF_SUFFIXES = {
+    clang.cindex.TypeKind.LVALUEREFERENCE: ' &',
+    clang.cindex.TypeKind.RVALUEREFERENCE: ' &&',
+    clang.cindex.TypeKind.POINTER: ' *'}
+
+# Type qualifier prefixes indexed by bit mask: 1 - const, 2 - volatile, 4 - restrict
+_CV_PREFIXES = ('', 'const ', 'volatile ', 'const volatile ',
+                'restrict ', 'const restrict ', 'volatile restrict ', 'const volatile restrict ')
+
+
 class CursorWrapper(object):
+    __slots__ = ('_full_name', '_full_specialized_name', '_arguments', 'no_const', 'no_volatile', 'no_restrict',
+                 'cursor', 'type')
+
     def __init__(self, cursor_or_type=None, type=None, no_const=False, no_volatile=False, no_restrict=False):
         self._full_name = None
         self._full_specialized_name = None
@@ -560,20 +724,17 @@ class CursorWrapper(object):
                 self.type = type
 
     def is_dereferencable(self):
-        return self.type.kind in (clang.cindex.TypeKind.LVALUEREFERENCE,
-                                  clang.cindex.TypeKind.RVALUEREFERENCE,
-                                  clang.cindex.TypeKind.POINTER)
+        return self.type.kind in _DEREFERENCABLE_TYPE_KINDS
 
     def is_reference(self):
-        return self.type.kind in (clang.cindex.TypeKind.LVALUEREFERENCE, clang.cindex.TypeKind.RVALUEREFERENCE)
+        return self.type.kind in _REFERENCE_TYPE_KINDS
 
     def is_pointer(self):
-        return self.type.kind in (clang.cindex.TypeKind.POINTER,)
+        return self.type.kind == clang.cindex.TypeKind.POINTER
 
     def is_function(self):
-        return (self.cursor.kind in (clang.cindex.CursorKind.CXX_METHOD,
-                                     clang.cindex.CursorKind.FUNCTION_DECL)) or \
-               (self.type.kind in (clang.cindex.TypeKind.FUNCTIONPROTO,))
+        return (self.cursor.kind in _FUNCTION_CURSOR_KINDS or
+                self.type.kind == clang.cindex.TypeKind.FUNCTIONPROTO)
 
     def is_const(self):
         return not self.no_const and self.type and self.type.is_const_qualified()
@@ -664,64 +825,31 @@ class CursorWrapper(object):
         else:
             return ''
 
+    @property
+    def cv_prefix(self):
+        return _CV_PREFIXES[(1 if self.is_const() else 0) |
+                            (2 if self.is_volatile() else 0) |
+                            (4 if self.is_restrict() else 0)]
+
+    def _compute_name(self, name_fn):
+        if self.cursor.kind == clang.cindex.CursorKind.NO_DECL_FOUND:
+            suffix = _DEREF_SUFFIXES.get(self.type.kind)
+            if suffix is not None:
+                return self.cv_prefix + self.deref()._compute_name(name_fn) + suffix
+        if self.cursor:
+            return self.cv_prefix + name_fn(self.cursor)
+        return ''
+
     @property
     def full_name(self):
         if self._full_name is None:
-            prefix = ''
-            if self.is_const():
-                prefix = 'const '
-            if self.is_restrict():
-                prefix += 'restrict '
-            if self.is_volatile():
-                prefix += 'volatile '
-
-            if self.cursor.kind == clang.cindex.CursorKind.NO_DECL_FOUND:
-                if self.is_dereferencable():
-                    if self.type.kind == clang.cindex.TypeKind.LVALUEREFERENCE:
-                        suffix = '&'
-                    elif self.type.kind == clang.cindex.TypeKind.RVALUEREFERENCE:
-                        suffix = '&&'
-                    elif self.type.kind == clang.cindex.TypeKind.POINTER:
-                        suffix = '*'
-                    else:
-                        assert False
-                    self._full_name = prefix + self.deref().full_name + ' ' + suffix
-
-            if self._full_name is None and self.cursor:
-                self._full_name = prefix + get_full_name(self.cursor)
-            else:
-                self._full_name = ''
-
+            self._full_name = self._compute_name(get_full_name)
         return self._full_name
 
     @property
     def full_specialized_name(self):
         if self._full_specialized_name is None:
-            prefix = ''
-            if self.is_const():
-                prefix = 'const '
-            if self.is_restrict():
-                prefix += 'restrict '
-            if self.is_volatile():
-                prefix += 'volatile '
-
-            if self.cursor.kind == clang.cindex.CursorKind.NO_DECL_FOUND:
-                if self.is_dereferencable():
-                    if self.type.kind == clang.cindex.TypeKind.LVALUEREFERENCE:
-                        suffix = '&'
-                    elif self.type.kind == clang.cindex.TypeKind.RVALUEREFERENCE:
-                        suffix = '&&'
-                    elif self.type.kind == clang.cindex.TypeKind.POINTER:
-                        suffix = '*'
-                    else:
-                        assert False
-                    self._full_specialized_name = prefix + self.deref().full_specialized_name + ' ' + suffix
-
-            if self._full_specialized_name is None and self.cursor:
-                self._full_specialized_name = prefix + get_full_specialized_name(self.cursor)
-            else:
-                self._full_specialized_name = ''
-
+            self._full_specialized_name = self._compute_name(get_full_specialized_name)
         return self._full_specialized_name
 
     @staticmethod
@@ -732,39 +860,242 @@ class CursorWrapper(object):
             return CursorWrapper(c)
 
 
-def build_translation_unit(config_file_name, compiler_command_line, libpath='', resource_dir=''):
-    config = configparser.ConfigParser()
-    config.add_section('Main')
-    config.set('Main', 'libpath', libpath)
-    config.set('Main', 'resource-dir', resource_dir)
-    if os.path.exists(config_file_name):
-        config.read(config_file_name)
-    libpath = config.get('Main', 'libpath')
-    resource_dir = config.get('Main', 'resource-dir')
+def read_config_section(config_file_name, section='Main'):
+    """Returns dict of options in given section of INI-style configuration file"""
+    options = {}
+    if not os.path.exists(config_file_name):
+        return options
+    current_section = None
+    with open(config_file_name) as config_file:
+        for line in config_file:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                current_section = line[1:-1].strip()
+            elif current_section == section:
+                sep_pos = min(pos for pos in (line.find('='), line.find(':'), len(line)) if pos >= 0)
+                options[line[:sep_pos].strip().lower()] = line[sep_pos + 1:].strip()
+    return options
+
+
+_INDEX = None
+
+
+def _get_ast_cache_paths(cache_dir, parse_args):
+    """Returns paths of the AST file and of its dependency list for the given clang arguments"""
+    key = json.dumps([os.getcwd()] + list(parse_args))
+    base_name = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+    return base_name + '.ast', base_name + '.deps'
+
+
+def _load_cached_translation_unit(ast_path, deps_path):
+    """Returns translation unit stored in ast_path or None when missing or out of date"""
+    try:
+        with open(deps_path) as deps_file:
+            deps = json.load(deps_file)
+        for file_name, mtime in deps:
+            if os.path.getmtime(file_name) != mtime:
+                return None
+        return _INDEX.read(ast_path)
+    except (IOError, OSError, ValueError, clang.cindex.TranslationUnitLoadError):
+        return None
+
+
+def _save_cached_translation_unit(tu, ast_path, deps_path):
+    """Stores tu together with modification times of all files it was parsed from"""
+    file_names = set(include.include.name for include in tu.get_includes())
+    file_names.add(tu.spelling)
+    try:
+        deps = [(file_name, os.path.getmtime(file_name)) for file_name in sorted(file_names)]
+        cache_dir = os.path.dirname(ast_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Both files are written to temporary files of this process and renamed into place,
+        # so concurrent runs never read a partially written AST whose (old) dependency list still matches
+        tmp_suffix = '.%d.tmp' % os.getpid()
+        tmp_ast_path = ast_path + tmp_suffix
+        tmp_deps_path = deps_path + tmp_suffix
+        try:
+            tu.save(tmp_ast_path)
+            os.rename(tmp_ast_path, ast_path)
+            # Dependency list is written last, an AST file without it is never used
+            with open(tmp_deps_path, 'w') as deps_file:
+                json.dump(deps, deps_file)
+            os.rename(tmp_deps_path, deps_path)
+        finally:
+            for tmp_path in (tmp_ast_path, tmp_deps_path):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    except (IOError, OSError, clang.cindex.TranslationUnitSaveError):
+        pass
+
+
+_ERROR_SEVERITIES = frozenset((clang.cindex.Diagnostic.Error, clang.cindex.Diagnostic.Fatal))
+
+
+def get_error_diagnostics(tu):
+    """Returns error and fatal diagnostics of tu"""
+    return [diag for diag in tu.diagnostics if diag.severity in _ERROR_SEVERITIES]
+
+
+def _has_errors(tu):
+    # Stops at the first error, diagnostics are fetched from libclang one by one
+    return any(diag.severity in _ERROR_SEVERITIES for diag in tu.diagnostics)
+
+
+# Extensions of arguments that name input files of the compiler
+_SOURCE_FILE_EXTENSIONS = frozenset(('.c', '.cc', '.cp', '.cpp', '.cxx', '.c++', '.h', '.hh', '.hpp', '.hxx', '.h++',
+                                     '.ipp', '.tcc', '.inl'))
+
+
+# Compiler options whose operand is the next argument, the operand is not a main input file
+# (-include and -imacros files are searched in the include paths)
+_OPTIONS_WITH_OPERAND = frozenset((
+    '-include', '-imacros', '-include-pch', '-include-pth', '-o', '-MF', '-MT', '-MQ', '-x', '-Xclang',
+    '-Xpreprocessor', '-Xassembler', '-Xlinker', '-I', '-isystem', '-idirafter', '-iquote', '-iprefix',
+    '-iwithprefix', '-iwithprefixbefore', '-isysroot', '-cxx-isystem', '-ivfsoverlay', '-D', '-U', '-F',
+    '-arch', '-target', '-resource-dir', '-working-directory'))
+
+
+def get_source_file_args(compiler_command_line):
+    """Returns main input files of compiler_command_line, relative paths are resolved against -working-directory"""
+    source_files = []
+    working_directory = None
+    args = iter(compiler_command_line)
+    for arg in args:
+        if arg in _OPTIONS_WITH_OPERAND:
+            operand = next(args, None)
+            if arg == '-working-directory':
+                working_directory = operand
+        elif arg.startswith('-working-directory='):
+            working_directory = arg[len('-working-directory='):]
+        elif not arg.startswith('-') and os.path.splitext(arg)[1].lower() in _SOURCE_FILE_EXTENSIONS:
+            source_files.append(arg)
+    if working_directory:
+        source_files = [os.path.join(working_directory, f) for f in source_files]
+    return source_files
+
+
+def get_missing_source_files(compiler_command_line):
+    """Returns main input files of compiler_command_line that do not exist"""
+    return [f for f in get_source_file_args(compiler_command_line) if not os.path.isfile(f)]
+
+
+def _prefetch_source_files(compiler_command_line):
+    """Asks the kernel to start reading the source files into the page cache before libclang opens them"""
+    posix_fadvise = getattr(os, 'posix_fadvise', None)  # Python 3.3+ on POSIX systems
+    if posix_fadvise is None:
+        return
+    for source_file in get_source_file_args(compiler_command_line):
+        try:
+            fd = os.open(source_file, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+COMPILATION_DATABASE_FILE_NAME = 'compile_commands.json'
+
+
+def get_compilation_database_dir(compile_commands):
+    """Returns directory of compilation database compile_commands, which is either a directory or a file named
+    compile_commands.json, libclang only loads databases by directory"""
+    path = os.path.abspath(compile_commands)
+    if os.path.isdir(path):
+        return path
+    if os.path.basename(path) != COMPILATION_DATABASE_FILE_NAME:
+        raise ValueError("compilation database '%s' must be a directory or a file named %s" %
+                         (compile_commands, COMPILATION_DATABASE_FILE_NAME))
+    return os.path.dirname(path)
+
+
+def get_compile_command_line(compile_commands_file, source_files):
+    """Returns compiler command line of the single file in source_files recorded in compile_commands_file"""
+    if len(source_files) != 1:
+        raise ValueError('exactly one source file is required with a compilation database, got %d' %
+                         len(source_files))
+    source_file = os.path.abspath(source_files[0])
+    database = clang.cindex.CompilationDatabase.fromDirectory(get_compilation_database_dir(compile_commands_file))
+    commands = database.getCompileCommands(source_file)
+    for command in commands or ():
+        # First argument is the compiler, relative paths refer to the directory of the command
+        return ['-working-directory', command.directory] + list(command.arguments)[1:]
+    raise ValueError('no compile command for %s in %s' % (source_file, compile_commands_file))
+
+
+def build_translation_unit(config_file_name, compiler_command_line, libpath='', resource_dir='', cache_dir=None,
+                           compile_commands=None):
+    """Parses the compiler command line with libclang.
+    When compile_commands is given, compiler_command_line lists the source file to look up in that compilation
+    database. When cache_dir is given, the parsed AST is saved there and reused as long as no parsed file changed.
+    """
+    global _INDEX
+
+    config = read_config_section(config_file_name)
+    libpath = config.get('libpath', libpath)
+    resource_dir = config.get('resource-dir', resource_dir)
 
     if not clang.cindex.Config.loaded:
         clang.cindex.Config.set_library_path(libpath)
-    index = clang.cindex.Index.create()
+    if _INDEX is None:
+        _INDEX = clang.cindex.Index.create()
+
+    if compile_commands:
+        compiler_command_line = get_compile_command_line(compile_commands, compiler_command_line)
 
     options = ['-x', 'c++', '-std=c++11', '-D__arvida_parse__']
     if resource_dir:
         options.extend(['-resource-dir', resource_dir])
 
-    tu = index.parse(None, options + compiler_command_line)
+    parse_args = options + compiler_command_line
+
+    if not cache_dir:
+        _prefetch_source_files(compiler_command_line)
+        return _INDEX.parse(None, parse_args)
+
+    ast_path, deps_path = _get_ast_cache_paths(cache_dir, parse_args)
+    tu = _load_cached_translation_unit(ast_path, deps_path)
+    if tu is None:
+        _prefetch_source_files(compiler_command_line)
+        tu = _INDEX.parse(None, parse_args)
+        # Failed parses are not cached, so that their diagnostics are always reported
+        if not _has_errors(tu):
+            _save_cached_translation_unit(tu, ast_path, deps_path)
     return tu
 
 
 def build_name_dict(translation_unit, cursor_filter=is_named_scope):
     names = defaultdict(list)
-    for cursor in translation_unit.cursor.walk_preorder():
-        if cursor_filter and not cursor_filter(cursor):
+    # Test the default filter inline against its kind set
+    kinds = _NAMED_SCOPE_KINDS if cursor_filter is is_named_scope else None
+    full_name = get_full_name
+    for cursor in walk_preorder(translation_unit.cursor):
+        if kinds is not None:
+            if cursor.kind not in kinds:
+                continue
+        elif cursor_filter and not cursor_filter(cursor):
             continue
-        names[get_full_name(cursor)].append(cursor)
+        names[full_name(cursor)].append(cursor)
     return names
 
 
+_KIND_NAMES = {}  # cursor kind --> name without enumeration prefix
+
+
 def get_kind_name(cursor):
-    return str(cursor.kind)[str(cursor.kind).index('.') + 1:]
+    kind = cursor.kind
+    try:
+        return _KIND_NAMES[kind]
+    except KeyError:
+        kind_str = str(kind)
+        name = _KIND_NAMES[kind] = kind_str[kind_str.index('.') + 1:]
+        return name
 
 
 def unquote_string_literal(s):
@@ -792,6 +1123,8 @@ class AnnotationParam(object):
 
     _kind_names = ('INVALID_PARAM', 'STRING_PARAM', 'OBJECT_PARAM', 'TYPE_PARAM')
 
+    __slots__ = ('kind', 'value', 'full_name')
+
     def __init__(self, kind, value):
         self.kind = kind
         self.value = value
@@ -841,25 +1174,31 @@ class AnnotationParam(object):
 
 
 def collect_annotation_params(cursor):
-    result = []
+    try:
+        roots = list(cursor)
+    except TypeError:
+        roots = [cursor]
 
-    def visitor(cursor):
-        for child in cursor.get_children():
-            annotation = AnnotationParam.from_cursor(child)
-            if annotation:
+    result = []
+    from_cursor = AnnotationParam.from_cursor
+    # Depth-first search with a stack of child iterators, parameters are collected in source order
+    stack = [iter(root.get_children()) for root in reversed(roots)]
+    while stack:
+        for child in stack[-1]:
+            annotation = from_cursor(child)
+            if annotation is not None:
                 result.append(annotation)
             else:
-                visitor(child)
-
-    try:
-        for e in cursor:
-            visitor(e)
-    except TypeError:
-        visitor(cursor)
+                stack.append(iter(child.get_children()))
+                break
+        else:
+            stack.pop()
     return result
 
 
 class Annotation(object):
+    __slots__ = ('name', 'params')
+
     def __init__(self, name, params=None):
         self.name = name
         if params is None:
@@ -879,21 +1218,20 @@ class Annotation(object):
 
 
 class AnnotatedItem(object):
+    __slots__ = ('action', 'item', 'annotations', 'full_name')
+
     def __init__(self, action, item, annotations):
         self.action = action
         self.item = item
         self.annotations = annotations
+        self.full_name = '' if item is None else str(item)
 
     def is_global(self):
         return self.item is None
 
-    @property
-    def full_name(self):
-        return '' if self.item is None else str(self.item)
-
     @property
     def name(self):
-        return '' if self.item is None else str(self.item)
+        return self.full_name
 
     def __repr__(self):
         return '<AnnotatedItem %s %s %r>' % (self.action, self.item, self.annotations)
@@ -927,48 +1265,59 @@ class AnnotatedItem(object):
                 if param.is_string():
                     annotation_name = str(param)
             else:
-                annotation_params.append(param)
+                annotation_params.append(str(param))
 
         return AnnotatedItem(cursor.spelling, item, annotations)
 
 
+_PARAM_END_PREFIX = PARAM_END + '-'
+_PARAM_BEGIN_PREFIX_LEN = len(PARAM_BEGIN_PREFIX)
+_PARAM_VALUE_PREFIX_LEN = len(PARAM_VALUE_PREFIX)
+
+
 def get_annotations_from_cursor(node):
     result = defaultdict(list)
+    # Read display names of annotation attributes only once, each access is a libclang call
+    annotations = [c.displayname for c in get_children(node)
+                   if c.kind == _K_ANNOTATE_ATTR]
+    if not annotations:
+        return result
     current_param_name = None
     current_param_value = None
-    for c in reversed(list(node.get_children())):
-        if c.kind == clang.cindex.CursorKind.ANNOTATE_ATTR:
-            if current_param_name is not None:
-                # print("NODE", node.displayname, "CD", c.displayname, "N", current_param_name, "V",
-                #       current_param_value, file=sys.stderr)
-                if c.displayname.startswith(PARAM_END + '-'):
-                    result[current_param_name].append(tuple(current_param_value))
-                    current_param_name = None
-                    current_param_value = None
-                elif c.displayname.startswith(PARAM_VALUE_PREFIX):
-                    value = c.displayname[len(PARAM_VALUE_PREFIX):]
-                    begin_value_pos = value.find(':')
-                    if begin_value_pos != -1:
-                        value = value[begin_value_pos + 1:]
-                    current_param_value.append(value)
-            elif c.displayname.startswith(PARAM_BEGIN_PREFIX):
-                current_param_name = c.displayname[len(PARAM_BEGIN_PREFIX):]
-                end_name_pos = current_param_name.rfind('-')
-                if end_name_pos != -1:
-                    current_param_name = current_param_name[:end_name_pos]
-                current_param_value = []
-                # print("NODE", node.displayname, "CD", c.displayname, "N", current_param_name,
-                #       "V", current_param_value, file=sys.stderr)
-            else:
-                # print("ANNO", c.displayname, file=sys.stderr)
-                key_value_pair = c.displayname.split('=', 1)
-                result[key_value_pair[0]].append(key_value_pair[1] if len(key_value_pair) > 1 else True)
+    for displayname in reversed(annotations):
+        if current_param_name is not None:
+            # print("NODE", node.displayname, "CD", displayname, "N", current_param_name, "V",
+            #       current_param_value, file=sys.stderr)
+            if displayname.startswith(_PARAM_END_PREFIX):
+                result[current_param_name].append(tuple(current_param_value))
+                current_param_name = None
+                current_param_value = None
+            elif displayname.startswith(PARAM_VALUE_PREFIX):
+                value = displayname[_PARAM_VALUE_PREFIX_LEN:]
+                begin_value_pos = value.find(':')
+                if begin_value_pos != -1:
+                    value = value[begin_value_pos + 1:]
+                current_param_value.append(value)
+        elif displayname.startswith(PARAM_BEGIN_PREFIX):
+            current_param_name = displayname[_PARAM_BEGIN_PREFIX_LEN:]
+            end_name_pos = current_param_name.rfind('-')
+            if end_name_pos != -1:
+                current_param_name = current_param_name[:end_name_pos]
+            current_param_value = []
+            # print("NODE", node.displayname, "CD", displayname, "N", current_param_name,
+            #       "V", current_param_value, file=sys.stderr)
+        else:
+            # print("ANNO", displayname, file=sys.stderr)
+            key, sep, value = displayname.partition('=')
+            result[key].append(value if sep else True)
     if current_param_name is not None:
         result[current_param_name].append(tuple(current_param_value))
     return result
 
 
 class Annotatable(object):
+    __slots__ = ('cursor', 'cw', 'annotations')
+
     def __init__(self, cursor):
         self.cursor = cursor
         self.cw = CursorWrapper.create(cursor)
@@ -985,6 +1334,8 @@ class Annotatable(object):
 
 
 class Type(object):
+    __slots__ = ('type',)
+
     def __init__(self, type):
         self.type = type
 
@@ -1029,9 +1380,7 @@ class Type(object):
             return self.type.spelling
 
     def get_non_pointer_type(self):
-        if self.type.kind in (clang.cindex.TypeKind.LVALUEREFERENCE,
-                              clang.cindex.TypeKind.RVALUEREFERENCE,
-                              clang.cindex.TypeKind.POINTER):
+        if self.type.kind in _DEREFERENCABLE_TYPE_KINDS:
             return self.get_pointee()
         else:
             return self
@@ -1059,6 +1408,8 @@ class Type(object):
 
 
 class Field(Annotatable):
+    __slots__ = ('name', 'access', 'type')
+
     def __init__(self, cursor):
         super(Field, self).__init__(cursor)
         self.name = cursor.spelling
@@ -1078,24 +1429,25 @@ class Field(Annotatable):
 
 
 class Function(Annotatable):
+    __slots__ = ('name', 'access', 'result_type', 'argument_types', '_is_getter', '_is_setter')
+
     def __init__(self, cursor):
         super(Function, self).__init__(cursor)
         self.name = cursor.spelling
         self.access = cursor.access_specifier
         self.result_type = Type(cursor.result_type)
         self.argument_types = [Type(t.type) for t in cursor.get_arguments()]
+        # FIXME improve getter/setter detection
+        is_function = self.cw.is_function()
+        num_args = len(self.argument_types)
+        self._is_getter = is_function and self.name.startswith('get') and num_args <= 1
+        self._is_setter = is_function and self.name.startswith('set') and num_args == 1
 
     def is_getter(self):
-        # FIXME improve getter/setter detection
-        return self.name.startswith('get') and \
-               self.cw.is_function() and \
-               (len(self.cw.arguments) == 0 or len(self.cw.arguments) == 1)
+        return self._is_getter
 
     def is_setter(self):
-        # FIXME improve getter/setter detection
-        return self.name.startswith('set') and \
-               self.cw.is_function() and \
-               len(self.cw.arguments) == 1
+        return self._is_setter
 
     def __repr__(self):
         flags = []
@@ -1107,12 +1459,24 @@ class Function(Annotatable):
 
 
 class TemplateParam(object):
+    __slots__ = ('cursor', 'name')
+
     def __init__(self, cursor):
         self.cursor = cursor
         self.name = cursor.spelling
 
 
+# Child kinds of a class that are only processed when publicly accessible
+_CLASS_MEMBER_KINDS = frozenset((
+    clang.cindex.CursorKind.CXX_METHOD,
+    clang.cindex.CursorKind.FIELD_DECL,
+    clang.cindex.CursorKind.UNION_DECL,
+    clang.cindex.CursorKind.STRUCT_DECL))
+
+
 class Class(Annotatable):
+    # No __slots__, the generator attaches code generation state (paths, triples, ...) to classes
+
     def __init__(self, cursor, env):
         super(Class, self).__init__(cursor)
         self.full_name = get_full_name(cursor)
@@ -1126,62 +1490,83 @@ class Class(Annotatable):
         self._annotated_sub_classes = set()
 
         anonymous = []
-        for c in cursor.get_children():
-            if (c.kind == clang.cindex.CursorKind.CXX_METHOD and
-                    c.access_specifier == clang.cindex.AccessSpecifier.PUBLIC):
-                f = Function(c)
-                self._functions.append(f)
-            elif (c.kind == clang.cindex.CursorKind.FIELD_DECL and
-                  c.access_specifier == clang.cindex.AccessSpecifier.PUBLIC):
-                f = Field(c)
-                self._fields.append(f)
-            elif (c.kind == clang.cindex.CursorKind.UNION_DECL and not c.spelling and
-                  c.access_specifier == clang.cindex.AccessSpecifier.PUBLIC):
-                anonymous.append(c)
-            elif (c.kind == clang.cindex.CursorKind.STRUCT_DECL and not c.spelling and
-                  c.access_specifier == clang.cindex.AccessSpecifier.PUBLIC):
-                anonymous.append(c)
-            elif c.kind == clang.cindex.CursorKind.CLASS_DECL or \
-                    c.kind == clang.cindex.CursorKind.STRUCT_DECL:
+        for c in get_children(cursor):
+            kind = c.kind
+            if kind in _CLASS_MEMBER_KINDS:
+                if c.access_specifier != _PUBLIC:
+                    if kind == _K_STRUCT_DECL:
+                        env.from_child(c)
+                elif kind == _K_CXX_METHOD:
+                    self._functions.append(Function(c))
+                elif kind == _K_FIELD_DECL:
+                    self._fields.append(Field(c))
+                elif not c.spelling:
+                    anonymous.append(c)
+                elif kind == _K_STRUCT_DECL:
+                    env.from_child(c)
+            elif kind == _K_CLASS_DECL:
                 env.from_child(c)
-            elif c.kind == clang.cindex.CursorKind.CXX_BASE_SPECIFIER:
+            elif kind == _K_CXX_BASE_SPECIFIER:
                 base = get_full_name(c.get_definition() or c)
                 assert base is not None
                 self._bases.append(base)
-            elif c.kind == clang.cindex.CursorKind.TEMPLATE_TYPE_PARAMETER:
+            elif kind == _K_TEMPLATE_TYPE_PARAMETER:
                 self._template_params.append(TemplateParam(c))
 
         if anonymous:
             # Remove all unnamed unions and structs that are used in fields
+            used = set()
             for field in self._fields:
-                for fieldChild in field.cursor.get_children():
-                    if fieldChild in anonymous:
-                        anonymous.remove(fieldChild)
+                used.update(get_children(field.cursor))
+            anonymous = [a for a in anonymous if a not in used]
 
         self.anonymous = [Class(a, env) for a in anonymous]
+        self._member_index = None
+        self._has_member_annotations = False
 
     def is_template(self):
-        return self.cursor.kind in [clang.cindex.CursorKind.CLASS_TEMPLATE]
+        return self.cursor.kind == _K_CLASS_TEMPLATE
 
     def has_annotations(self, check_recursively=False):
-        if super(Class, self).has_annotations(check_recursively):
+        if self.annotations:
             return True
         if check_recursively:
+            # Annotations are only ever added, so a positive result stays valid
+            if self._has_member_annotations:
+                return True
             for f in self._functions:
-                if f.has_annotations(True):
+                if f.annotations:
+                    self._has_member_annotations = True
                     return True
             for f in self._fields:
-                if f.has_annotations(True):
+                if f.annotations:
+                    self._has_member_annotations = True
                     return True
         return False
 
+    def _get_member_index(self):
+        """Returns flat lists of fields, functions and members and a dict name --> members,
+        including members of anonymous unions and structs"""
+        if self._member_index is None:
+            fields = list(self._fields)
+            functions = list(self._functions)
+            members = self._fields + self._functions
+            members_by_name = defaultdict(list)
+            for m in members:
+                members_by_name[m.name].append(m)
+            for cls in self.anonymous:
+                cls_fields, cls_functions, cls_members, cls_members_by_name = cls._get_member_index()
+                fields.extend(cls_fields)
+                functions.extend(cls_functions)
+                members.extend(cls_members)
+                for name, cls_named_members in cls_members_by_name.items():
+                    members_by_name[name].extend(cls_named_members)
+            self._member_index = (fields, functions, members, dict(members_by_name))
+        return self._member_index
+
     def find_field(self, name):
-        for m in self._fields:
-            if m.name == name:
-                return m
-        for cls in self.anonymous:
-            m = cls.find_field(name)
-            if m:
+        for m in self._get_member_index()[3].get(name, ()):
+            if isinstance(m, Field):
                 return m
         return None
 
@@ -1193,39 +1578,19 @@ class Class(Annotatable):
         return result
 
     def find_members(self, name):
-        result = []
-        for m in self._fields:
-            if m.name == name:
-                result.append(m)
-        for m in self._functions:
-            if m.name == name:
-                result.append(m)
-        for cls in self.anonymous:
-            m = cls.find_members(name)
-            if m:
-                result.extend(m)
-        return result
+        return list(self._get_member_index()[3].get(name, ()))
 
     @property
     def fields(self):
-        fldlist = [self._fields]
-        for cls in self.anonymous:
-            fldlist.append(cls.fields)
-        return itertools.chain(*fldlist)
+        return iter(self._get_member_index()[0])
 
     @property
     def functions(self):
-        fnlist = [self._functions]
-        for cls in self.anonymous:
-            fnlist.append(cls.functions)
-        return itertools.chain(*fnlist)
+        return iter(self._get_member_index()[1])
 
     @property
     def members(self):
-        mlist = [self._fields, self._functions]
-        for cls in self.anonymous:
-            mlist.append(cls.members)
-        return itertools.chain(*mlist)
+        return iter(self._get_member_index()[2])
 
     @property
     def bases(self):
@@ -1247,28 +1612,111 @@ class Class(Annotatable):
         return '<Class %s>' % (self.full_name,)
 
 
+_ANNOTATION_FUNCTION_NAMES = frozenset((
+    "arvida_reflect_get_type_ptr",
+    "arvida_reflect_object",
+    "arvida_reflect_object_ext",
+    "arvida_global_annotation_func"))
+
+
 def build_annotations(cursor):
     result = []
 
-    def visitor(cursor):
-        for child in cursor.get_children():
-            if (child.kind == clang.cindex.CursorKind.CALL_EXPR and
-                    (child.spelling == "arvida_reflect_get_type_ptr" or
-                     child.spelling == "arvida_reflect_object" or
-                     child.spelling == "arvida_reflect_object_ext" or
-                     child.spelling == "arvida_global_annotation_func")):
-                annotation = AnnotatedItem.from_cursor(child)
-                assert annotation is not None
-                result.append(annotation)
-            else:
-                visitor(child)
-
-    for child in cursor.get_children():
-        visitor(child)
+    # Pre-order traversal with explicit stack, children are pushed reversed to keep source order
+    stack = list(cursor.get_children())
+    stack.reverse()
+    while stack:
+        child = stack.pop()
+        if (child.kind == _K_CALL_EXPR and
+                child.spelling in _ANNOTATION_FUNCTION_NAMES):
+            annotation = AnnotatedItem.from_cursor(child)
+            assert annotation is not None
+            result.append(annotation)
+        else:
+            children = list(child.get_children())
+            children.reverse()
+            stack.extend(children)
 
     return result
 
 
+# Global annotation name --> key in Environment.global_annotations
+_GLOBAL_ANNOTATION_KEYS = {
+    'arvida-include': 'include',
+    'arvida-prolog': 'prolog',
+    'arvida-epilog': 'epilog',
+    'arvida-uid-method': 'uid-method',
+}
+
+
+def _annotate_members(cls, member_name, key, value):
+    for member in cls.find_members(member_name):
+        member.add_annotation(key, value)
+
+
+def _apply_object_semantic(cls, params):
+    for s in params:
+        cls.add_annotation('semantic', s)
+
+
+def _apply_field_semantic(cls, params):
+    field = cls.find_field(params[0])
+    if field:
+        field.add_annotation('semantic', params[1])
+
+
+def _apply_member_semantic(cls, params):
+    _annotate_members(cls, params[0], 'semantic', params[1])
+
+
+def _apply_annotate_member(cls, params):
+    _annotate_members(cls, params[0], params[1], params[2])
+
+
+def _apply_class_stmt(cls, params):
+    cls.add_annotation('triple', (params[0], params[1], params[2]))
+
+
+def _apply_class_include(cls, params):
+    cls.add_annotation('include', params[0])
+
+
+def _apply_class_use_visitor(cls, params):
+    cls.add_annotation('use-visitor', params[0])
+
+
+def _apply_member_stmt(cls, params):
+    _annotate_members(cls, params[0], 'triple', (params[1], params[2], params[3]))
+
+
+def _apply_member_path(cls, params):
+    _annotate_members(cls, params[0], 'path', params[1])
+
+
+def _apply_member_absolute_path(cls, params):
+    _annotate_members(cls, params[0], 'absolute-path', params[1])
+
+
+def _apply_member_create_element(cls, params):
+    _annotate_members(cls, params[0], 'create-element', params[1])
+
+
+# Class annotation name --> function(cls, params) that applies it
+_CLASS_ANNOTATION_HANDLERS = {
+    'arvida-object-semantic': _apply_object_semantic,
+    'arvida-field-semantic': _apply_field_semantic,
+    'arvida-member-semantic': _apply_member_semantic,
+    'arvida-annotate-member': _apply_annotate_member,
+    'arvida-class-stmt': _apply_class_stmt,
+    'arvida-class-include': _apply_class_include,
+    'arvida-class-use-visitor': _apply_class_use_visitor,
+    'arvida-member-stmt': _apply_member_stmt,
+    'arvida-member-path': _apply_member_path,
+    'arvida-member-absolute-path': _apply_member_absolute_path,
+    'arvida-member-create-element': _apply_member_create_element,
+}
+
+
 class Environment(object):
     def __init__(self):
         self.classes = []
@@ -1303,116 +1751,53 @@ class Environment(object):
         self.annotations.extend(annotations)
 
     def build_index(self):
-        self.annotated_classes.clear()
+        # Annotated classes are collected in an OrderedDict (key --> None), whose
+        # insertion and membership test are cheaper than the OrderedSet methods
+        annotated_classes = OrderedDict()
         self.name_to_class_map.clear()
         for cls in self.classes:
             self.name_to_class_map[cls.full_name] = cls
             if cls.has_annotations(True):
-                self.annotated_classes.add(cls)
-        for a in self.annotations:
-            if not a.is_global():
-                self.name_to_annotation_map[a.name] = a
+                annotated_classes[cls] = None
         for a in self.annotations:
             # Global annotations
             if a.is_global():
                 for ga in a.annotations:
-                    if ga.name == 'arvida-include':
-                        s = str(ga.params[0])
-                        self.add_global_annotation('include', s)
-                    elif ga.name == 'arvida-prolog':
-                        s = str(ga.params[0])
-                        self.add_global_annotation('prolog', s)
-                    elif ga.name == 'arvida-epilog':
-                        s = str(ga.params[0])
-                        self.add_global_annotation('epilog', s)
-                    elif ga.name == 'arvida-uid-method':
-                        s = str(ga.params[0])
-                        self.add_global_annotation('uid-method', s)
+                    key = _GLOBAL_ANNOTATION_KEYS.get(ga.name)
+                    if key is not None:
+                        self.add_global_annotation(key, ga.params[0])
+                continue
+
+            self.name_to_annotation_map[a.full_name] = a
 
             # Class annotations
             cls = self.name_to_class_map.get(a.full_name, None)
             if cls is None:
                 continue
-            if cls not in self.annotated_classes:
-                self.annotated_classes.add(cls)
+            annotated_classes[cls] = None
             for ca in a.annotations:
-                if ca.name == 'arvida-object-semantic':
-                    for s in ca.params:
-                        cls.add_annotation('semantic', str(s))
-                elif ca.name == 'arvida-field-semantic':
-                    field_name = str(ca.params[0])
-                    anno_value = str(ca.params[1])
-                    field = cls.find_field(field_name)
-                    if field:
-                        field.add_annotation('semantic', anno_value)
-                elif ca.name == 'arvida-member-semantic':
-                    member_name = str(ca.params[0])
-                    anno_value = str(ca.params[1])
-                    members = cls.find_members(member_name)
-                    for member in members:
-                        member.add_annotation('semantic', anno_value)
-                elif ca.name == 'arvida-annotate-member':
-                    member_name = str(ca.params[0])
-                    anno_name = str(ca.params[1])
-                    anno_value = str(ca.params[2])
-                    members = cls.find_members(member_name)
-                    for member in members:
-                        member.add_annotation(anno_name, anno_value)
-                elif ca.name == 'arvida-class-stmt':
-                    a = str(ca.params[0])
-                    b = str(ca.params[1])
-                    c = str(ca.params[2])
-                    cls.add_annotation('triple', (a, b, c))
-                elif ca.name == 'arvida-class-include':
-                    include = str(ca.params[0])
-                    cls.add_annotation('include', include)
-                elif ca.name == 'arvida-class-use-visitor':
-                    use_visitor = str(ca.params[0])
-                    cls.add_annotation('use-visitor', use_visitor)
-                elif ca.name == 'arvida-member-stmt':
-                    member_name = str(ca.params[0])
-                    a = str(ca.params[1])
-                    b = str(ca.params[2])
-                    c = str(ca.params[3])
-                    members = cls.find_members(member_name)
-                    for member in members:
-                        member.add_annotation('triple', (a, b, c))
-                elif ca.name == 'arvida-member-path':
-                    member_name = str(ca.params[0])
-                    path = str(ca.params[1])
-                    members = cls.find_members(member_name)
-                    for member in members:
-                        member.add_annotation('path', path)
-                elif ca.name == 'arvida-member-absolute-path':
-                    member_name = str(ca.params[0])
-                    path = str(ca.params[1])
-                    members = cls.find_members(member_name)
-                    for member in members:
-                        member.add_annotation('absolute-path', path)
-                elif ca.name == 'arvida-member-create-element':
-                    member_name = str(ca.params[0])
-                    name = str(ca.params[1])
-                    members = cls.find_members(member_name)
-                    for member in members:
-                        member.add_annotation('create-element', name)
+                handler = _CLASS_ANNOTATION_HANDLERS.get(ca.name)
+                if handler is not None:
+                    handler(cls, ca.params)
 
         for method_name in self.global_annotations.get('uid-method', []):
             for cls in self.classes:
                 methods = cls.find_functions(method_name)
                 if methods:
                     cls.add_annotation('uid-method', method_name)
-                    if cls not in self.annotated_classes:
-                        self.annotated_classes.add(cls)
+                    annotated_classes[cls] = None
+
+        self.annotated_classes = OrderedSet(annotated_classes)
 
         # Update base- and sub-class relations
-        for cls in self.classes:
-            for base in cls.bases:
-                base_cls = self.name_to_class_map.get(base)
-                if base_cls:
-                    if base_cls in self.annotated_classes:
-                        cls.annotated_base_classes.add(base_cls)
-                    if cls in self.annotated_classes:
-                        base_cls.annotated_sub_classes.add(cls)
+        name_to_class_map = self.name_to_class_map
+        edges = [(cls, name_to_class_map[base])
+                 for cls in self.classes for base in cls.bases if base in name_to_class_map]
+        for cls, base_cls in edges:
+            if base_cls in annotated_classes:
+                cls.annotated_base_classes.add(base_cls)
+            if cls in annotated_classes:
+                base_cls.annotated_sub_classes.add(cls)
 
         # Collect prolog and epilog
         self.prolog = []
@@ -1465,43 +1850,65 @@ class Environment(object):
         result.processed_files = processed_files
         result.include_file = cursor.translation_unit.spelling
 
-        for c in cursor.get_children():
-            if c.is_definition() and (cursor_filter(c) if cursor_filter else True):
-                result.from_child(c, cursor_filter=cursor_filter)
-
-        result.build_index()
+        # Stack of (environment, children iterator) instead of recursion into namespaces. As before, every
+        # namespace gets an environment of its own, which is indexed and merged into its parent when completed.
+        stack = [(result, iter(cursor.get_children()))]
+        while stack:
+            env, children = stack[-1]
+            for c in children:
+                if c.is_definition() and (cursor_filter(c) if cursor_filter else True):
+                    if c.kind == _K_NAMESPACE:
+                        stack.append((Environment(), iter(c.get_children())))
+                        break
+                    env.from_child(c, cursor_filter=cursor_filter)
+            else:
+                stack.pop()
+                env.build_index()
+                if stack:
+                    stack[-1][0].extend(env)
         return result
 
     def from_child(self, c, cursor_filter=None):
-        if c.kind in [clang.cindex.CursorKind.CLASS_DECL, clang.cindex.CursorKind.CLASS_TEMPLATE]:
+        kind = c.kind
+        if kind == _K_CLASS_DECL or kind == _K_CLASS_TEMPLATE:
             a_class = Class(c, self)
             self.append_class(a_class)
-        elif (c.kind == clang.cindex.CursorKind.STRUCT_DECL
+        elif (kind == _K_STRUCT_DECL
               and len(c.spelling) > 0):
             a_class = Class(c, self)
             self.append_class(a_class)
-        elif c.kind == clang.cindex.CursorKind.NAMESPACE:
+        elif kind == _K_NAMESPACE:
             child_env = Environment.from_cursor(c, cursor_filter=cursor_filter)
             self.extend(child_env)
-        elif c.kind == clang.cindex.CursorKind.FUNCTION_DECL:
+        elif kind == _K_FUNCTION_DECL:
             self.extend_annotations(build_annotations(c))
 
     def dump(self):
+        return ''.join(self.iter_dump())
+
+    def dump_to(self, out):
+        """Writes dump to the text stream out without building it in memory first"""
+        for line in self.iter_dump():
+            out.write(line)
+
+    def iter_dump(self):
         from . import asciitree
 
         def dump_node_children(node):
-            children = []
-
             if isinstance(node, Environment):
-                children.extend(iter(node.global_annotations.items()))
-                children.extend(node.classes)
-                return children
+                for item in node.global_annotations.items():
+                    yield item
+                for cls in node.classes:
+                    yield cls
+                return
             if isinstance(node, Annotatable):
-                children.extend(list(node.annotations.items()))
+                for item in node.annotations.items():
+                    yield item
             if isinstance(node, Class):
-                children.extend(node.template_params)
-                children.extend(node.members)
-            return children
+                for param in node.template_params:
+                    yield param
+                for member in node.members:
+                    yield member
 
         def dump_node(node):
             if isinstance(node, Environment):
@@ -1523,4 +1930,4 @@ class Environment(object):
                 return 'Annotation {} : {}'.format(node[0], node[1])
             return ''
 
-        return asciitree.draw_tree(self, dump_node_children, dump_node)
+        return asciitree.iter_tree(self, dump_node_children, dump_node)
@@ -31,58 +31,54 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 from builtins import object
-from io import StringIO
 
 
 def draw_tree(node,
               child_iter=lambda n: n.children,
               text_str=lambda n: str(n)):
-    return _draw_tree(node, '', False, child_iter, text_str)
+    return ''.join(iter_tree(node, child_iter, text_str))
 
 
-def _draw_tree(node, prefix, last_node, child_iter, text_str):
-    buf = StringIO()
-
+def iter_tree(node,
+              child_iter=lambda n: n.children,
+              text_str=lambda n: str(n)):
+    """Yields the lines of draw_tree one node at a time, so that large trees can be written out incrementally"""
+    out = []
+    # Explicit stack of (node, prefix, last_node), children are pushed reversed
+    stack = [(node, '', False)]
+    while stack:
+        node, prefix, last_node = stack.pop()
+        _draw_node(node, prefix, last_node, child_iter, text_str, out, stack)
+        for line in out:
+            yield line
+        del out[:]
+
+
+def _draw_node(node, prefix, last_node, child_iter, text_str, out, stack):
     children = list(child_iter(node))
 
     # check if root node
     s = text_str(node).split('\n')
     if not s:
         s = ['']
-    i = s[0]
     if prefix:
-        buf.write(prefix[:-3])
-        buf.write('  +--')
-    buf.write(i)
-    buf.write('\n')
+        out.append(prefix[:-3] + '  +--' + s[0] + '\n')
+    else:
+        out.append(s[0] + '\n')
 
-    for i in s[1:]:
+    if len(s) > 1:
+        line_prefix = ''
         if prefix:
-            buf.write(prefix[:-3])
-            if last_node:
-                buf.write('     ')
-            else:
-                buf.write('  |  ')
-        if children:
-            buf.write('|')
-        else:
-            buf.write(' ')
-        buf.write(i)
-        buf.write('\n')
-
-    for index, child in enumerate(children):
-        if index + 1 == len(children):
-            sub_prefix = prefix + '   '
-            last_node = True
-        else:
-            sub_prefix = prefix + '  |'
-            last_node = False
-
-        buf.write(
-            _draw_tree(child, sub_prefix, last_node, child_iter, text_str)
-        )
-
-    return buf.getvalue()
+            line_prefix = prefix[:-3] + ('     ' if last_node else '  |  ')
+        line_prefix += '|' if children else ' '
+        for i in s[1:]:
+            out.append(line_prefix + i + '\n')
+
+    if children:
+        stack.append((children[-1], prefix + '   ', True))
+        sub_prefix = prefix + '  |'
+        for child in reversed(children[:-1]):
+            stack.append((child, sub_prefix, False))
 
 
 if __name__ == '__main__':
@@ -17,12 +17,75 @@
 from __future__ import absolute_import
 from builtins import range
 from builtins import object
+from multiprocessing.pool import ThreadPool
 import arvidapp
 import clang
 from . import asciitree
 
 
+# Names of extra cursor flags, the flag with index i has bit value 1 << i
+_EXTRA_FLAG_NAMES = ('const_qualified', 'volatile_qualified', 'pod', 'reference', 'function',
+                     'function_variadic', 'function_type_const_qualified',
+                     'function_result_type_pointee_const_qualified')
+_EXTRA_STRINGS = {}  # bit mask --> space separated flag names
+
+
+def _extra_string(mask):
+    try:
+        return _EXTRA_STRINGS[mask]
+    except KeyError:
+        s = _EXTRA_STRINGS[mask] = ' '.join(name for i, name in enumerate(_EXTRA_FLAG_NAMES) if mask & (1 << i))
+        return s
+
+
+# Builtin types, they have no declaration, pointee or template arguments
+_PRIMITIVE_TYPE_KINDS = frozenset((
+    clang.cindex.TypeKind.VOID,
+    clang.cindex.TypeKind.BOOL,
+    clang.cindex.TypeKind.CHAR_U,
+    clang.cindex.TypeKind.UCHAR,
+    clang.cindex.TypeKind.CHAR16,
+    clang.cindex.TypeKind.CHAR32,
+    clang.cindex.TypeKind.USHORT,
+    clang.cindex.TypeKind.UINT,
+    clang.cindex.TypeKind.ULONG,
+    clang.cindex.TypeKind.ULONGLONG,
+    clang.cindex.TypeKind.UINT128,
+    clang.cindex.TypeKind.CHAR_S,
+    clang.cindex.TypeKind.SCHAR,
+    clang.cindex.TypeKind.WCHAR,
+    clang.cindex.TypeKind.SHORT,
+    clang.cindex.TypeKind.INT,
+    clang.cindex.TypeKind.LONG,
+    clang.cindex.TypeKind.LONGLONG,
+    clang.cindex.TypeKind.INT128,
+    clang.cindex.TypeKind.FLOAT,
+    clang.cindex.TypeKind.DOUBLE,
+    clang.cindex.TypeKind.LONGDOUBLE,
+    clang.cindex.TypeKind.NULLPTR))
+
+
+# Detailed cursor description, formatted with positional arguments to avoid per call keyword processing
+_CURSOR_FORMAT = ('%s%s %r\n'
+                  ' spelling = %r\n'
+                  ' displayname = %r\n'
+                  ' is type = %s\n'
+                  ' is template = %s\n'
+                  ' is specialized template = %s\n'
+                  ' is definition = %s\n'
+                  ' type.kind = %s\n'
+                  ' type_spelling = %r\n'
+                  ' semantic parents = %r\n'
+                  ' usr = %r\n'
+                  ' full name = %r\n'
+                  ' full specialized name = %r%s\n'
+                  ' num_template_arguments=%s\n'
+                  ' %s\n')
+
+
 class PrintText(object):
+    __slots__ = ('text',)
+
     def __init__(self, text):
         self.text = text
 
@@ -33,139 +96,152 @@ class PrintText(object):
         return ()
 
 
-class PrintCursor(object):
-    def __init__(self, cursor, name=None, cursor_filter=None, max_depth=-1, visited=None, depth=0):
-        self.name = name
-        self.cursor = cursor
+class DumpContext(object):
+    """State shared by all nodes of one dump, visited contains the visited types"""
+    __slots__ = ('cursor_filter', 'max_depth', 'visited', 'visited_cursors', '_accepted')
+
+    def __init__(self, cursor_filter=None, max_depth=-1, visited=None):
         self.cursor_filter = cursor_filter
         self.max_depth = max_depth
         assert visited is None or isinstance(visited, set)
         self.visited = set() if visited is None else visited
+        self.visited_cursors = set()
+        self._accepted = {}  # cursor --> result of cursor_filter
+
+    def accepts(self, cursor):
+        """Returns result of cursor_filter for cursor, the filter is called at most once per cursor"""
+        if self.cursor_filter is None:
+            return True
+        result = self._accepted.get(cursor)
+        if result is None:
+            result = bool(self.cursor_filter(cursor))
+            self._accepted[cursor] = result
+        return result
+
+
+class PrintCursor(object):
+    __slots__ = ('cursor', 'name', 'ctx', 'depth', 'detail', '_is_type')
+
+    def __init__(self, cursor, name=None, ctx=None, depth=0, detail=True):
+        self.name = name
+        self.cursor = cursor
+        self.ctx = DumpContext() if ctx is None else ctx
         self.depth = depth
-        # assert self.max_depth != -1
+        # When False only kind and text are printed, used for nodes whose children are not shown
+        self.detail = detail
+        self._is_type = None
+
+    def is_type(self):
+        if self._is_type is None:
+            self._is_type = arvidapp.is_type(self.cursor)
+        return self._is_type
 
     def print_node(self):
         node = self.cursor
-        text = node.spelling or node.displayname
+        # Each accessor is a libclang call, so read them only once
+        spelling = node.spelling
+        displayname = node.displayname
+        text = spelling or displayname
         kind = arvidapp.get_kind_name(node)
+        name = self.name + ' ' if self.name else ''
+
+        if not self.detail:
+            return '{name}{kind} {text!r}\n'.format(name=name, kind=kind, text=text)
+
+        node_type = node.type
+        node_type_kind = node_type.kind
 
-        extra = []
-        if node.type.is_const_qualified():
-            extra.append('const_qualified')
-        if node.type.is_volatile_qualified():
-            extra.append('volatile_qualified')
-        if node.type.is_pod():
-            extra.append('pod')
+        extra = 0
+        if node_type.is_const_qualified():
+            extra |= 1
+        if node_type.is_volatile_qualified():
+            extra |= 2
+        if node_type.is_pod():
+            extra |= 4
         if node.kind.is_reference():
-            extra.append('reference')
-        if node.type.kind == clang.cindex.TypeKind.FUNCTIONPROTO:
-            extra.append('function')
-            if node.type.is_function_variadic():
-                extra.append('function_variadic')
-            if node.type.get_result().is_const_qualified():
-                extra.append('function_type_const_qualified')
+            extra |= 8
+        if node_type_kind == clang.cindex.TypeKind.FUNCTIONPROTO:
+            extra |= 16
+            if node_type.is_function_variadic():
+                extra |= 32
+            if node_type.get_result().is_const_qualified():
+                extra |= 64
             if node.result_type.get_pointee().is_const_qualified():
-                extra.append('function_result_type_pointee_const_qualified')
+                extra |= 128
 
-        name = self.name + ' ' if self.name else ''
+        location = node.location
+        location_file = location.file
+        file = '\n file = {}:{}:{}'.format(location_file, location.line,
+                                           location.column) if location_file else ''
 
-        file = '\n file = {}:{}:{}'.format(node.location.file, node.location.line,
-                                           node.location.column) if node.location.file else ''
-
-        return '{name}{kind} {text!r}\n' \
-               ' spelling = {spelling!r}\n' \
-               ' displayname = {displayname!r}\n' \
-               ' is type = {is_type}\n' \
-               ' is template = {is_template}\n' \
-               ' is specialized template = {is_specialized_template}\n' \
-               ' is definition = {is_definition}\n' \
-               ' type.kind = {type.kind}\n' \
-               ' type_spelling = {type_spelling!r}\n' \
-               ' semantic parents = {semantic_parents!r}\n' \
-               ' usr = {usr!r}\n' \
-               ' full name = {full_name!r}\n' \
-               ' full specialized name = {full_specialized_name!r}{file}\n' \
-               ' num_template_arguments={num_template_arguments}\n' \
-               ' {extra}\n'.format(
-            name=name,
-            kind=kind,
-            usr=node.get_usr(),
-            text=text,
-            type=node.type,
-            spelling=node.spelling,
-            type_spelling=arvidapp.type_spelling(node),
-            is_type=arvidapp.is_type(node),
-            is_template=arvidapp.is_template(node),
-            is_specialized_template=arvidapp.is_specialized_template(node),
-            is_definition=node.is_definition(),
-            semantic_parents=arvidapp.semantic_parents(node),
-            displayname=node.displayname,
-            full_name=arvidapp.get_full_name(node),
-            full_specialized_name=arvidapp.get_full_specialized_name(node),
-            file=file,
-            num_template_arguments=node.get_num_template_arguments(),
-            extra=' '.join(extra))
+        return _CURSOR_FORMAT % (
+            name,
+            kind,
+            text,
+            spelling,
+            displayname,
+            self.is_type(),
+            arvidapp.is_template(node),
+            arvidapp.is_specialized_template(node),
+            node.is_definition(),
+            node_type_kind,
+            arvidapp.type_spelling(node),
+            arvidapp.semantic_parents(node),
+            node.get_usr(),
+            arvidapp.get_full_name(node),
+            arvidapp.get_full_specialized_name(node),
+            file,
+            node.get_num_template_arguments(),
+            _extra_string(extra))
 
     def get_children(self):
         children = []
+        ctx = self.ctx
+        depth = self.depth + 1
 
-        if 0 <= self.max_depth <= self.depth:
+        if 0 <= ctx.max_depth <= self.depth:
             children.append(PrintText('max depth reached'))
             return children
+        # Children at the maximal depth do not show their own children
+        detail = not (0 <= ctx.max_depth <= depth)
 
-        if self.cursor in self.visited:
+        if self.cursor in ctx.visited_cursors:
             children.append(PrintText('already visited'))
             return children
 
-        self.visited.add(self.cursor)
+        ctx.visited_cursors.add(self.cursor)
 
-        if arvidapp.is_type(self.cursor) and \
-                self.cursor.type and self.cursor.type.kind != clang.cindex.TypeKind.INVALID:
-            children.append(PrintType('.type', self.cursor.type, src_cursor=self.cursor, visited=self.visited,
-                                      cursor_filter=self.cursor_filter,
-                                      max_depth=self.max_depth,
-                                      depth=self.depth + 1))
-        if self.cursor.kind.is_reference():
-            children.append(
-                PrintCursor(self.cursor.referenced, name='.referenced', visited=self.visited,
-                            cursor_filter=self.cursor_filter,
-                            max_depth=self.max_depth,
-                            depth=self.depth + 1))
-        elif self.cursor.kind == clang.cindex.CursorKind.TYPEDEF_DECL:
+        kind = self.cursor.kind
+        cursor_type = self.cursor.type
+        child_types = set()  # types that are already children of this node
+
+        if self.is_type() and \
+                cursor_type and cursor_type.kind != clang.cindex.TypeKind.INVALID:
+            children.append(PrintType('.type', cursor_type, src_cursor=self.cursor, ctx=ctx, depth=depth))
+            child_types.add(cursor_type)
+        if kind.is_reference():
+            children.append(PrintCursor(self.cursor.referenced, name='.referenced', ctx=ctx, depth=depth,
+                                        detail=detail))
+        elif kind == clang.cindex.CursorKind.TYPEDEF_DECL:
             children.append(
                 PrintType('.underlying_typedef_type', self.cursor.underlying_typedef_type, src_cursor=self.cursor,
-                          cursor_filter=self.cursor_filter,
-                          max_depth=self.max_depth,
-                          visited=self.visited, depth=self.depth + 1))
-        elif self.cursor.kind == clang.cindex.CursorKind.CXX_METHOD:
-            children.append(PrintType('.type', self.cursor.type, src_cursor=self.cursor,
-                                      cursor_filter=self.cursor_filter,
-                                      max_depth=self.max_depth,
-                                      visited=self.visited,
-                                      depth=self.depth + 1))
-            children.append(PrintType('.type.get_result()', self.cursor.type.get_result(), src_cursor=self.cursor,
-                                      cursor_filter=self.cursor_filter,
-                                      max_depth=self.max_depth,
-                                      visited=self.visited, depth=self.depth + 1))
-            children.append(
-                PrintType('.result_type', self.cursor.result_type, src_cursor=self.cursor,
-                          cursor_filter=self.cursor_filter,
-                          max_depth=self.max_depth,
-                          visited=self.visited,
-                          depth=self.depth + 1))
-
-        if self.cursor.kind == clang.cindex.CursorKind.COMPOUND_STMT or \
-                ((self.cursor_filter and not self.cursor_filter(self.cursor)) \
-                         and self.cursor.kind == clang.cindex.CursorKind.NAMESPACE):
+                          ctx=ctx, depth=depth))
+        elif kind == clang.cindex.CursorKind.CXX_METHOD:
+            # Result type usually equals .type.get_result(), show every distinct type only once
+            for name, t in (('.type', cursor_type),
+                            ('.type.get_result()', cursor_type.get_result()),
+                            ('.result_type', self.cursor.result_type)):
+                if t not in child_types:
+                    child_types.add(t)
+                    children.append(PrintType(name, t, src_cursor=self.cursor, ctx=ctx, depth=depth))
+
+        if kind == clang.cindex.CursorKind.COMPOUND_STMT or \
+                (kind == clang.cindex.CursorKind.NAMESPACE and not ctx.accepts(self.cursor)):
             children.append(PrintText('ignored children'))
         else:
             for c in self.cursor.get_children():
-                do_process_file = (not self.cursor_filter or self.cursor_filter(c))
-                if do_process_file or self.depth > 1:
-                    children.append(PrintCursor(c, cursor_filter=self.cursor_filter,
-                                                visited=self.visited,
-                                                max_depth=self.max_depth,
-                                                depth=self.depth + 1))
+                if self.depth > 1 or ctx.accepts(c):
+                    children.append(PrintCursor(c, ctx=ctx, depth=depth, detail=detail))
         # children.extend([PrintCursor(c, name='.get_arguments()') for c in self.cursor.get_arguments()])
         # children.extend([PrintCursor(c) for c in self.cursor.get_children() if should_process_file(c.location.file, source_files)])
         # for c in self.cursor.walk_preorder():
@@ -175,15 +251,14 @@ class PrintCursor(object):
 
 
 class PrintType(object):
-    def __init__(self, name, type, src_cursor=None, cursor_filter=None, max_depth=-1, visited=set(), depth=0):
+    __slots__ = ('name', 'type', 'src_cursor', 'ctx', 'depth')
+
+    def __init__(self, name, type, src_cursor=None, ctx=None, depth=0):
         self.name = name
         self.type = type
         self.src_cursor = src_cursor
-        self.cursor_filter = cursor_filter
-        self.max_depth = max_depth
-        self.visited = visited
+        self.ctx = DumpContext() if ctx is None else ctx
         self.depth = depth
-        # assert self.max_depth != -1
 
     def print_node(self):
         return '{name} {type.kind} {type.spelling!r}'.format(
@@ -192,40 +267,32 @@ class PrintType(object):
 
     def get_children(self):
         children = []
+        ctx = self.ctx
+        depth = self.depth + 1
 
-        if 0 <= self.max_depth <= self.depth:
+        if 0 <= ctx.max_depth <= self.depth:
             children.append(PrintText('max depth reached'))
             return children
 
-        if self.type in self.visited:
+        if self.type.kind in _PRIMITIVE_TYPE_KINDS:
+            return children
+
+        if self.type in ctx.visited:
             children.append(PrintText('already visited'))
             return children
-        self.visited.add(self.type)
+        ctx.visited.add(self.type)
 
         type_decl = self.type.get_declaration()
         if type_decl and type_decl.kind != clang.cindex.CursorKind.NO_DECL_FOUND and \
                 (type_decl != self.src_cursor if self.src_cursor else True):
-            children.append(
-                PrintCursor(type_decl, name='.get_declaration()',
-                            cursor_filter=self.cursor_filter,
-                            visited=self.visited,
-                            max_depth=self.max_depth,
-                            depth=self.depth + 1))
-        if self.type.kind in [clang.cindex.TypeKind.LVALUEREFERENCE]:
-            children.append(
-                PrintType('.get_pointee()', self.type.get_pointee(),
-                          cursor_filter=self.cursor_filter,
-                          visited=self.visited,
-                          max_depth=self.max_depth,
-                          depth=self.depth + 1))
-        if self.type.get_num_template_arguments():
-            for i in range(self.type.get_num_template_arguments()):
-                children.append(PrintType('.get_template_argument({})'.format(i),
-                                          self.type.get_template_argument_type(i),
-                                          cursor_filter=self.cursor_filter,
-                                          visited=self.visited,
-                                          max_depth=self.max_depth,
-                                          depth=self.depth + 1))
+            children.append(PrintCursor(type_decl, name='.get_declaration()', ctx=ctx, depth=depth,
+                                        detail=not (0 <= ctx.max_depth <= depth)))
+        if self.type.kind == clang.cindex.TypeKind.LVALUEREFERENCE:
+            children.append(PrintType('.get_pointee()', self.type.get_pointee(), ctx=ctx, depth=depth))
+        for i in range(self.type.get_num_template_arguments()):
+            children.append(PrintType('.get_template_argument({})'.format(i),
+                                      self.type.get_template_argument_type(i),
+                                      ctx=ctx, depth=depth))
         return children
 
 
@@ -234,5 +301,17 @@ def dump_ast(tu_or_cursor, cursor_filter=None, max_depth=-1):
         cursor = tu_or_cursor.cursor
     else:
         cursor = tu_or_cursor
-    return asciitree.draw_tree(PrintCursor(cursor, cursor_filter=cursor_filter, max_depth=max_depth),
+    ctx = DumpContext(cursor_filter=cursor_filter, max_depth=max_depth)
+    return asciitree.draw_tree(PrintCursor(cursor, ctx=ctx),
                                lambda node: node.get_children(), lambda node: node.print_node())
+
+
+def dump_asts(tus_or_cursors, cursor_filter=None, max_depth=-1, workers=None):
+    """Returns list of dump_ast results, the dumps run in a thread pool since libclang calls release the GIL"""
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(lambda tu_or_cursor: dump_ast(tu_or_cursor, cursor_filter=cursor_filter, max_depth=max_depth),
+                        tus_or_cursors)
+    finally:
+        pool.close()
+        pool.join()
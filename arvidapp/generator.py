@@ -14,13 +14,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from past.builtins import cmp
 from builtins import next
 from builtins import object
 import arvidapp
 import itertools
 import jinja2
-from collections import OrderedDict
+import re
+from collections import OrderedDict, namedtuple
 
 
 def enum(**enums):
@@ -36,6 +36,8 @@ def is_emptystring(s):
 
 
 class TextValue(object):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -44,6 +46,8 @@ class TextValue(object):
 
 
 class SubstValue(object):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -51,39 +55,34 @@ class SubstValue(object):
         return "SubstValue(%r)" % (self.value,)
 
 
+# Escaped character, opening brace, closing brace or run of other characters
+_INLINE_TEMPLATE_TOKEN_RE = re.compile(r'\\(.)|(\{)|(\})|([^\\{}]+)', re.DOTALL)
+
+
 def parse_inline_template(s):
     result = []
-    curstr = ''
+    cur = []
     brace_level = 0
-    i = 0
-    slen = len(s)
-    as_is = False
-    while i < slen:
-        c = s[i]
-        i += 1
-        if as_is:
-            as_is = False
-        else:
-            if c == '\\':
-                as_is = True
+    for m in _INLINE_TEMPLATE_TOKEN_RE.finditer(s):
+        escaped, open_brace, close_brace, text = m.groups()
+        if open_brace:
+            brace_level += 1
+            if brace_level == 1:
+                if cur:
+                    result.append(TextValue(''.join(cur)))
+                    cur = []
                 continue
-            if c == '{':
-                brace_level += 1
-                if brace_level == 1:
-                    if len(curstr) != 0:
-                        result.append(TextValue(curstr))
-                    curstr = ''
-                    continue
-            elif c == '}':
-                if brace_level == 1:
-                    brace_level = 0
-                    result.append(SubstValue(curstr))
-                    curstr = ''
-                    continue
-                elif brace_level > 0:
-                    brace_level -= 1
-        curstr += c
-    if len(curstr) > 0:
+        elif close_brace:
+            if brace_level == 1:
+                brace_level = 0
+                result.append(SubstValue(''.join(cur)))
+                cur = []
+                continue
+            elif brace_level > 0:
+                brace_level -= 1
+        cur.append(escaped if escaped is not None else m.group())
+    if cur:
+        curstr = ''.join(cur)
         result.append(SubstValue(curstr) if brace_level > 0 else TextValue(curstr))
     return result
 
@@ -107,13 +106,15 @@ class CodeGenEnvironment(object):
 
 
 class TemplateObject(object):
+    __slots__ = ('kind', 'id')
+
     def __init__(self, kind, id):
         self.kind = kind
         self.id = id
 
 
 def normalize_annotation_value(value):
-    if (isinstance(value, tuple) or isinstance(value, list)) and len(value) == 1:
+    if isinstance(value, (tuple, list)) and len(value) == 1:
         return value[0]
     else:
         return value
@@ -126,16 +127,53 @@ DEFAULT_PATH_SUBST_LIST = (
     ('$ctx', 'ctx'))
 
 
+# Compiled alternation, replacement table and first characters of the old strings per substitution list
+_SUBST_PATTERNS = {}
+
+
+def _get_subst_pattern(subst_list):
+    key = tuple(subst_list)
+    entry = _SUBST_PATTERNS.get(key)
+    if entry is None:
+        # Longest first, so that a pattern never shadows a longer one sharing its prefix
+        olds = sorted(set(old for old, _ in key), key=len, reverse=True)
+        table = {}
+        for old, new in key:
+            table.setdefault(old, new)
+        pattern = re.compile('|'.join(re.escape(old) for old in olds)) if olds else None
+        first_chars = frozenset(old[0] for old in olds if old)
+        entry = _SUBST_PATTERNS[key] = (pattern, table, first_chars)
+    return entry
+
+
 def subst(str, subst_list):
-    for old, new in subst_list:
-        str = str.replace(old, new)
-    return str
+    """Replaces all occurrences of the old strings in subst_list in a single pass"""
+    pattern, table, first_chars = _get_subst_pattern(subst_list)
+    # Most values contain no variable at all, e.g. no '$' for the default lists
+    if pattern is None or not any(c in str for c in first_chars):
+        return str
+    return pattern.sub(lambda m: table[m.group(0)], str)
+
+
+# Results of _process_path per (unquoted_path, tuple(path_subst_list))
+_PATH_ANNOTATION_CACHE = {}
 
 
 def process_path_annotation(path_annotation_list, path_subst_list=DEFAULT_PATH_SUBST_LIST):
     """Returns tuple (quoted_path, unquoted_path, preprocessed_path)"""
-    paths = [normalize_annotation_value(p) for p in path_annotation_list]
-    unquoted_path = paths[-1] if paths else None
+    unquoted_path = normalize_annotation_value(path_annotation_list[-1]) if path_annotation_list else None
+    try:
+        key = (unquoted_path, tuple(path_subst_list))
+        result = _PATH_ANNOTATION_CACHE.get(key)
+    except TypeError:
+        # Unhashable annotation value, process without caching
+        return _process_path(unquoted_path, path_subst_list)
+    if result is None:
+        result = _PATH_ANNOTATION_CACHE[key] = _process_path(unquoted_path, path_subst_list)
+    return result
+
+
+def _process_path(unquoted_path, path_subst_list):
     path = arvidapp.quote_string_literal(unquoted_path) if unquoted_path else None
     pp_path = '""'
     if unquoted_path:
@@ -156,35 +194,22 @@ def process_path_annotation(path_annotation_list, path_subst_list=DEFAULT_PATH_S
     return path, unquoted_path, pp_path
 
 
-def cmp_to_key(mycmp):
-    'Convert a cmp= function into a key= function'
-
-    class K:
-        def __init__(self, obj, *args):
-            self.obj = obj
-
-        def __lt__(self, other):
-            return mycmp(self.obj, other.obj) < 0
-
-        def __gt__(self, other):
-            return mycmp(self.obj, other.obj) > 0
-
-        def __eq__(self, other):
-            return mycmp(self.obj, other.obj) == 0
+def triple_sort_key(triple):
+    """Triples referring $this sort first, followed by $that, $that.element, IRIs and blank nodes"""
+    subject, predicate, obj = triple.value
+    return subject.sort_weight + predicate.sort_weight + obj.sort_weight
 
-        def __le__(self, other):
-            return mycmp(self.obj, other.obj) <= 0
 
-        def __ge__(self, other):
-            return mycmp(self.obj, other.obj) >= 0
-
-        def __ne__(self, other):
-            return mycmp(self.obj, other.obj) != 0
-
-    return K
+_MEMBER_TYPES = (arvidapp.Field, arvidapp.Function)
 
 
 class MemberTripleContainer(TemplateObject):
+    __slots__ = ('triples', 'member_triples', 'member_element_triples', 'member', 'class_',
+                 '_has_that_ref', '_has_that_element_ref',
+                 'path_type', 'path', 'unquoted_path', 'pp_path',
+                 'element_path_type', 'absolute_element_path', 'element_path', 'unquoted_element_path',
+                 'pp_element_path', 'create_element', 'getter', 'setter')
+
     def __init__(self, member, class_, id):
         super(MemberTripleContainer, self).__init__('member', id)
         self.triples = []
@@ -192,12 +217,16 @@ class MemberTripleContainer(TemplateObject):
         self.member_element_triples = []  # Triples that refer $that.foreach, $that.element, or $that.item
         self.member = member
         self.class_ = class_
+        # Computed by process_triples
+        self._has_that_ref = None
+        self._has_that_element_ref = None
 
         # RdfPath / rdf_member_path
         # RdfAbsolutePath / rdf_member_absolute_path
         if member is not None:
-            paths = member.annotations.get('path', [])
-            absolute_paths = member.annotations.get('absolute-path', [])
+            annotations = member.annotations
+            paths = annotations.get('path', [])
+            absolute_paths = annotations.get('absolute-path', [])
             self.path_type = PathType.RELATIVE_PATH
             if absolute_paths:
                 paths = absolute_paths
@@ -206,8 +235,8 @@ class MemberTripleContainer(TemplateObject):
             if is_emptystring(self.pp_path):
                 self.path_type = PathType.NO_PATH
 
-            element_paths = member.annotations.get('element-path', paths)
-            absolute_element_paths = member.annotations.get('absolute-element-path', absolute_paths)
+            element_paths = annotations.get('element-path', paths)
+            absolute_element_paths = annotations.get('absolute-element-path', absolute_paths)
             self.element_path_type = PathType.RELATIVE_PATH
             if absolute_element_paths:
                 element_paths = absolute_element_paths
@@ -229,11 +258,11 @@ class MemberTripleContainer(TemplateObject):
         # RdfCreateElement
         self.create_element = None
         if member is not None:
-            annot = member.annotations.get('create-element', None)
+            annot = annotations.get('create-element', None)
             if annot:
                 self.create_element = arvidapp.first(normalize_annotation_value(annot))
 
-        if isinstance(self.member, arvidapp.Field) or isinstance(self.member, arvidapp.Function):
+        if isinstance(self.member, _MEMBER_TYPES):
             self.getter = self.member.is_getter()
             self.setter = self.member.is_setter()
         else:
@@ -272,25 +301,17 @@ class MemberTripleContainer(TemplateObject):
         return r
 
     def has_that_element_ref(self):
-        for triple in self.triples:
-            for i in triple:
-                if i.is_that_element_ref():
-                    return True
-        return False
+        if self._has_that_element_ref is None:
+            return any(triple.has_that_element_ref() for triple in self.triples)
+        return self._has_that_element_ref
 
     def has_that_ref(self):
-        for triple in self.triples:
-            for i in triple:
-                if i.is_that_ref():
-                    return True
-        return False
+        if self._has_that_ref is None:
+            return any(triple.has_that_ref() for triple in self.triples)
+        return self._has_that_ref
 
     def has_that_or_that_element_ref(self):
-        for triple in self.triples:
-            for i in triple:
-                if i.is_that_ref() or i.is_that_element_ref():
-                    return True
-        return False
+        return self.has_that_ref() or self.has_that_element_ref()
 
     def is_common(self):
         # Returns True if triple is not reader/writer-specific
@@ -307,49 +328,43 @@ class MemberTripleContainer(TemplateObject):
         Call this function after all triples are added
         :return:
         """
-        del self.member_triples[:]
-        del self.member_element_triples[:]
-
-        def node_value(v):
-            if v.is_this_ref():
-                return 1
-            if v.is_that_ref():
-                return 10
-            if v.is_that_element_ref():
-                return 100
-            if v.is_iri_node() or v.is_prefixed_name():
-                return 1000
-            if v.is_blank_node():
-                return 10000
-            return 100000
-
-        def cmp_triple(x, y):
-            x_value = node_value(x.subject) + node_value(x.predicate) + node_value(x.object)
-            y_value = node_value(y.subject) + node_value(y.predicate) + node_value(y.object)
-            return cmp(x_value, y_value)
-
-        triples = sorted(self.triples, key=cmp_to_key(cmp_triple))
-
-        for triple in triples:
-            has_element_ref = False
-            for i in triple:
-                if i.is_that_element_ref():
-                    has_element_ref = True
-                    break
-            if has_element_ref:
-                self.member_element_triples.append(triple)
-            else:
-                self.member_triples.append(triple)
+        triples = sorted(self.triples, key=triple_sort_key)
+
+        # Slice assignment keeps the list objects, templates may already refer to them
+        self.member_triples[:] = [triple for triple in triples if not triple._has_that_element_ref]
+        self.member_element_triples[:] = [triple for triple in triples if triple._has_that_element_ref]
+
+        self._has_that_ref = any(triple._has_that_ref for triple in triples)
+        self._has_that_element_ref = len(self.member_element_triples) > 0
 
     def __repr__(self):
         return 'MemberTripleContainer(member=%r,%r)' % (self.member, self.triples)
 
 
+# Node classes of triple nodes, see TripleNode.node_class
+NC_OTHER = 0
+NC_BLANK = 1
+NC_IRI = 2
+NC_PREFIXED = 3
+NC_VALUE = 4  # value node which is neither $this, $that nor $that.element
+NC_THIS = 5
+NC_THAT = 6
+NC_THAT_ELEM = 7
+
+_VALUE_NODE_CLASSES = frozenset((NC_VALUE, NC_THIS, NC_THAT, NC_THAT_ELEM))
+
+
 class TripleNode(TemplateObject):
     SUBJECT_POSITION = 'subject'
     PREDICATE_POSITION = 'predicate'
     OBJECT_POSITION = 'object'
 
+    # Order of the node kinds when triples are sorted, see triple_sort_key
+    sort_weight = 100000
+    node_class = NC_OTHER
+
+    __slots__ = ('position', 'triple', 'defined')
+
     def __init__(self, kind, id, position=None, triple=None):
         super(TripleNode, self).__init__(kind, id)
         self.position = position
@@ -358,48 +373,47 @@ class TripleNode(TemplateObject):
 
     def is_that_element_ref(self):
         """True if this node references to the container element of a member: $that.foreach or $that.container"""
-        return False
+        return self.node_class == NC_THAT_ELEM
 
     def is_that_ref(self):
         """True if this node references to the member: $that"""
-        return False
+        return self.node_class == NC_THAT
 
     def is_this_ref(self):
         """True if this node references to the parent class: $this"""
-        return False
+        return self.node_class == NC_THIS
 
     def is_blank_node(self):
         """True if this node is a blank node"""
-        return False
+        return self.node_class == NC_BLANK
 
     def is_iri_node(self):
         """True if this node is IRI node"""
-        return False
+        return self.node_class == NC_IRI
 
     def is_prefixed_name(self):
         """True if this node is prefixed name node"""
-        return False
+        return self.node_class == NC_PREFIXED
 
     def is_value_node(self):
         """True if this node is a value node ($this, $that, $that.foreach/$that.container)"""
-        return False
+        return self.node_class in _VALUE_NODE_CLASSES
 
 
-class BlankData(object):
-    def __init__(self, label, var_name):
-        self.label = label
-        self.var_name = var_name
+BlankData = namedtuple('BlankData', 'label var_name')
 
 
 class Blank(TripleNode):
+    sort_weight = 10000
+    node_class = NC_BLANK
+
+    __slots__ = ('data',)
+
     def __init__(self, data, id):
         super(Blank, self).__init__('blank', id)
         self.data = data
         self.defined = False
 
-    def is_blank_node(self):
-        return True
-
     @property
     def label(self):
         return self.data.label
@@ -413,52 +427,86 @@ class Blank(TripleNode):
 
 
 class IRI(TripleNode):
+    sort_weight = 1000
+    node_class = NC_IRI
+
+    __slots__ = ('value',)
+
     def __init__(self, value, id):
         super(IRI, self).__init__('iri', id)
         self.value = value
 
-    def is_iri_node(self):
-        return True
-
     def __repr__(self):
         return 'IRI(%r)' % (self.value,)
 
 
 class PrefixedName(TripleNode):
+    sort_weight = 1000
+    node_class = NC_PREFIXED
+
+    __slots__ = ('value', '_split_value')
+
     def __init__(self, value, id):
         super(PrefixedName, self).__init__('prefixed_name', id)
         self.value = value
-        unquoted_value = arvidapp.unquote_string_literal(value)
-        prefix_pos = unquoted_value.find(':')
-        if prefix_pos < 0:
-            self.prefix = ''
-            self.local_part = ''
-        else:
-            self.prefix = arvidapp.quote_string_literal(unquoted_value[:prefix_pos])
-            self.local_part = arvidapp.quote_string_literal(unquoted_value[prefix_pos + 1:])
+        self._split_value = None
+
+    def _split(self):
+        """Returns quoted (prefix, local_part), computed on first use"""
+        if self._split_value is None:
+            unquoted_value = arvidapp.unquote_string_literal(self.value)
+            prefix_pos = unquoted_value.find(':')
+            if prefix_pos < 0:
+                self._split_value = ('', '')
+            else:
+                self._split_value = (arvidapp.quote_string_literal(unquoted_value[:prefix_pos]),
+                                     arvidapp.quote_string_literal(unquoted_value[prefix_pos + 1:]))
+        return self._split_value
 
-    def is_prefixed_name(self):
-        return True
+    @property
+    def prefix(self):
+        return self._split()[0]
+
+    @property
+    def local_part(self):
+        return self._split()[1]
 
     def __repr__(self):
         return 'PrefixedName(%r)' % (self.value,)
 
 
-THAT_ELEMENT_NAMES = ('$that.foreach', '$that.element', '$that.item')
+THAT_ELEMENT_NAMES = frozenset(('$that.foreach', '$that.element', '$that.item'))
 
 
 class Value(TripleNode):
+    # sort_weight and node_class depend on the meta variable, so they are per instance
+    __slots__ = ('value', 'parent', 'meta_var', 'container', 'sort_weight', 'node_class',
+                 'absolute_path', 'path', 'unquoted_path', 'pp_path', 'getter', 'setter', 'tmpl_suffix', 'is_this')
+
     def __init__(self, value, parent, meta_var, id):
         super(Value, self).__init__('value', id)
         self.value = value
         self.parent = parent
         self.meta_var = meta_var
         self.container = meta_var in THAT_ELEMENT_NAMES
+        if meta_var == '$this':
+            self.sort_weight = 1
+            self.node_class = NC_THIS
+        elif meta_var == '$that':
+            self.sort_weight = 10
+            self.node_class = NC_THAT
+        elif self.container:
+            self.sort_weight = 100
+            self.node_class = NC_THAT_ELEM
+        else:
+            self.sort_weight = TripleNode.sort_weight
+            self.node_class = NC_VALUE
 
         # RdfPath / rdf_member_path
         # RdfAbsolutePath / rdf_member_absolute_path
-        paths = value.annotations.get('path', [])
-        absolute_paths = value.annotations.get('absolute-path', [])
+        annotations = value.annotations
+        paths = annotations.get('path', [])
+        absolute_paths = annotations.get('absolute-path', [])
         if absolute_paths:
             paths = absolute_paths
             self.absolute_path = True
@@ -466,39 +514,30 @@ class Value(TripleNode):
             self.absolute_path = False
         self.path, self.unquoted_path, self.pp_path = process_path_annotation(paths)
 
-        if isinstance(self.value, arvidapp.Field) or isinstance(self.value, arvidapp.Function):
-            self.getter = self.value.is_getter()
-            self.setter = self.value.is_setter()
+        is_function = isinstance(value, arvidapp.Function)
+        is_field = not is_function and isinstance(value, arvidapp.Field)
+
+        if is_function or is_field:
+            self.getter = value.is_getter()
+            self.setter = value.is_setter()
         else:
             self.getter = False
             self.setter = False
 
         self.defined = False
 
-        if self.meta_var == '$this':
+        if meta_var == '$this':
             self.tmpl_suffix = 'this'
             self.is_this = True
-        elif isinstance(self.value, arvidapp.Class):
-            self.tmpl_suffix = 'class'
-        elif isinstance(self.value, arvidapp.Function):
+        elif is_function:
             self.tmpl_suffix = 'function'
-        elif isinstance(self.value, arvidapp.Field):
+        elif is_field:
             self.tmpl_suffix = 'field'
+        elif isinstance(value, arvidapp.Class):
+            self.tmpl_suffix = 'class'
         else:
             self.tmpl_suffix = None
 
-    def is_that_element_ref(self):
-        return self.container
-
-    def is_that_ref(self):
-        return self.meta_var == '$that'
-
-    def is_this_ref(self):
-        return self.meta_var == '$this'
-
-    def is_value_node(self):
-        return True
-
     def is_absolute_path(self):
         return self.absolute_path
 
@@ -522,6 +561,8 @@ class Value(TripleNode):
 
 
 class Triple(TemplateObject):
+    __slots__ = ('value', '_has_that_ref', '_has_that_element_ref')
+
     def __init__(self, id, value=None):
         super(Triple, self).__init__('triple', id)
         if value is None:
@@ -531,6 +572,13 @@ class Triple(TemplateObject):
             for item in self.value:
                 if item is not None:
                     item.triple = self
+        self._update_refs()
+
+    def _update_refs(self):
+        """Caches whether nodes refer $that or $that.element, call after modification of self.value"""
+        node_classes = [v.node_class for v in self.value if v is not None]
+        self._has_that_ref = NC_THAT in node_classes
+        self._has_that_element_ref = NC_THAT_ELEM in node_classes
 
     def __len__(self):
         return len(self.value)
@@ -554,54 +602,43 @@ class Triple(TemplateObject):
                 value.position = TripleNode.PREDICATE_POSITION
             elif key == 2:
                 value.position = TripleNode.OBJECT_POSITION
+        self._update_refs()
 
-    @property
-    def that_position(self):
-        if self.value[0].is_that_ref():
+    def _position_of(self, node_class):
+        if self.value[0].node_class == node_class:
             return TripleNode.SUBJECT_POSITION
-        if self.value[1].is_that_ref():
+        if self.value[1].node_class == node_class:
             return TripleNode.PREDICATE_POSITION
-        if self.value[2].is_that_ref():
+        if self.value[2].node_class == node_class:
             return TripleNode.OBJECT_POSITION
         return None
 
+    @property
+    def that_position(self):
+        return self._position_of(NC_THAT)
+
     @property
     def that_element_position(self):
-        if self.value[0].is_that_element_ref():
-            return TripleNode.SUBJECT_POSITION
-        if self.value[1].is_that_element_ref():
-            return TripleNode.PREDICATE_POSITION
-        if self.value[2].is_that_element_ref():
-            return TripleNode.OBJECT_POSITION
-        return None
+        return self._position_of(NC_THAT_ELEM)
 
     def is_common(self):
         # Returns True if triple is not reader/writer-specific
         return not self.is_for_reader() and not self.is_for_writer()
 
     def is_for_reader(self):
-        return any([isinstance(v, Value) and v.is_setter() for v in self.value])
+        return any(isinstance(v, Value) and v.setter for v in self.value)
 
     def is_for_writer(self):
-        return any([isinstance(v, Value) and v.is_getter() for v in self.value])
+        return any(isinstance(v, Value) and v.getter for v in self.value)
 
     def has_that_element_ref(self):
-        for i in self.value:
-            if i.is_that_element_ref():
-                return True
-        return False
+        return self._has_that_element_ref
 
     def has_that_ref(self):
-        for i in self.value:
-            if i.is_that_ref():
-                return True
-        return False
+        return self._has_that_ref
 
     def has_that_or_that_element_ref(self):
-        for i in self.value:
-            if i.is_that_ref() or i.is_that_element_ref():
-                return True
-        return False
+        return self._has_that_ref or self._has_that_element_ref
 
     @property
     def subject(self):
@@ -610,6 +647,7 @@ class Triple(TemplateObject):
     @subject.setter
     def subject(self, value):
         self.value[0] = value
+        self._update_refs()
 
     @property
     def predicate(self):
@@ -618,6 +656,7 @@ class Triple(TemplateObject):
     @predicate.setter
     def predicate(self, value):
         self.value[1] = value
+        self._update_refs()
 
     @property
     def object(self):
@@ -626,6 +665,7 @@ class Triple(TemplateObject):
     @object.setter
     def object(self, value):
         self.value[2] = value
+        self._update_refs()
 
     def __repr__(self):
         return 'Triple(%r)' % (self.value,)
@@ -635,41 +675,50 @@ class TemplateProcessor(object):
     def __init__(self, template_group):
         self.template_group = template_group
 
-    def propagate_annotation(self, cls, annotation_name, annotation_value):
-        cls_annotation_value = cls.annotations.get(annotation_name, None)
-        if cls_annotation_value is None:
-            cls_annotation_value = annotation_value
-            if cls_annotation_value is not None:
-                if isinstance(cls_annotation_value, list):
-                    for i in cls_annotation_value:
-                        cls.add_annotation(annotation_name, i)
-                else:
-                    cls.add_annotation(annotation_name, cls_annotation_value)
-        if cls_annotation_value:
-            for sub_cls in cls.annotated_sub_classes:
-                self.propagate_annotation(sub_cls, annotation_name, cls_annotation_value)
+    def propagate_annotation(self, cls, annotation_name, annotation_value, propagated=None):
+        """Adds annotation_value to cls and its sub classes which do not have the annotation.
+        Classes in propagated already passed their annotation down and are skipped.
+        """
+        if propagated is None:
+            propagated = set()
+        stack = [(cls, annotation_value)]
+        while stack:
+            cls, annotation_value = stack.pop()
+            if cls in propagated:
+                continue
+            cls_annotation_value = cls.annotations.get(annotation_name, None)
+            if cls_annotation_value is None:
+                cls_annotation_value = annotation_value
+                if cls_annotation_value is not None:
+                    if isinstance(cls_annotation_value, list):
+                        for i in cls_annotation_value:
+                            cls.add_annotation(annotation_name, i)
+                    else:
+                        cls.add_annotation(annotation_name, cls_annotation_value)
+            if cls_annotation_value:
+                propagated.add(cls)
+                stack.extend((sub_cls, cls_annotation_value) for sub_cls in cls.annotated_sub_classes)
 
     def process_environment(self, environment):
 
+        propagated = set()
         for cls in environment.classes:
-            self.propagate_annotation(cls, 'uid-method', None)
+            self.propagate_annotation(cls, 'uid-method', None, propagated)
 
         # Process use-visitor annotation
         use_visitor_classes = set()
 
         def propagate_use_visitor(cls):
-            if cls in use_visitor_classes:
-                return
-            use_visitor_classes.add(cls)
-            cls.use_visitor = True
-            if len(cls.annotated_base_classes) == 0:
-                cls.use_visitor_top_class = True
-            else:
-                cls.use_visitor_top_class = False
-                for base_cls in cls.annotated_base_classes:
-                    propagate_use_visitor(base_cls)
-            for sub_cls in cls.annotated_sub_classes:
-                propagate_use_visitor(sub_cls)
+            stack = [cls]
+            while stack:
+                cls = stack.pop()
+                if cls in use_visitor_classes:
+                    continue
+                use_visitor_classes.add(cls)
+                cls.use_visitor = True
+                cls.use_visitor_top_class = len(cls.annotated_base_classes) == 0
+                stack.extend(cls.annotated_base_classes)
+                stack.extend(cls.annotated_sub_classes)
 
         for cls in environment.annotated_classes:
             if cls.annotations.get('use-visitor', None) is not None:
@@ -679,9 +728,10 @@ class TemplateProcessor(object):
 
         # Process per class path annotation
         for cls in environment.annotated_classes:
-            paths = cls.annotations.get('path', [])
-            absolute_paths = cls.annotations.get('absolute-path', [])
-            uid_method = cls.annotations.get('uid-method', None)
+            annotations = cls.annotations
+            paths = annotations.get('path', [])
+            absolute_paths = annotations.get('absolute-path', [])
+            uid_method = annotations.get('uid-method', None)
 
             cls.path_type = PathType.RELATIVE_PATH
             cls.uid_method = None
@@ -722,11 +772,13 @@ class TemplateProcessor(object):
             def create_triple(triple, member=None):
                 new_triple = Triple(id=next(id_gen))
                 for index, elem in enumerate(triple):
-                    if elem.startswith("_:"):
+                    # Dispatch on the first character, so that most elements are scanned only once
+                    first_char = elem[:1]
+                    if first_char == '_' and elem.startswith("_:"):
                         new_triple[index] = create_blank(elem, id_gen=id_gen)
-                    elif elem == "$this":
+                    elif first_char == '$' and elem == "$this":
                         new_triple[index] = Value(cls, parent=None, meta_var=elem, id=next(id_gen))
-                    elif elem == '$that' or elem in THAT_ELEMENT_NAMES:
+                    elif first_char == '$' and (elem == '$that' or elem in THAT_ELEMENT_NAMES):
                         if member is None:
                             raise Exception('Per class triple annotation cannot refer to %s' % elem)
                         else:
@@ -769,15 +821,26 @@ class TemplateProcessor(object):
                 cls.mtcs.append(mtc)
 
 
+_TEMPLATE_ENVIRONMENTS = {}  # template directory --> jinja2.Environment
+
+
+def get_template_environment(template_dir):
+    """Returns jinja2 environment for template_dir, it is created once so that compiled templates are reused"""
+    tmpl_env = _TEMPLATE_ENVIRONMENTS.get(template_dir)
+    if tmpl_env is None:
+        loader = jinja2.FileSystemLoader(template_dir)
+        tmpl_env = jinja2.Environment(loader=loader,
+                                      keep_trailing_newline=True,  # newline-terminate generated files
+                                      lstrip_blocks=True,  # so can indent control flow tags
+                                      trim_blocks=True)  # so don't need {%- -%} everywhere
+
+        tmpl_env.tests['emptystring'] = is_emptystring
+        _TEMPLATE_ENVIRONMENTS[template_dir] = tmpl_env
+    return tmpl_env
+
+
 def generate_from_template(environment, template_name, template_dir):
-    loader = jinja2.FileSystemLoader(template_dir)
-    tmpl_env = jinja2.Environment(loader=loader,
-                                  keep_trailing_newline=True,  # newline-terminate generated files
-                                  lstrip_blocks=True,  # so can indent control flow tags
-                                  trim_blocks=True)  # so don't need {%- -%} everywhere
-
-    tmpl_env.tests['emptystring'] = is_emptystring
-    tmpl = tmpl_env.get_template(template_name)
+    tmpl = get_template_environment(template_dir).get_template(template_name)
 
     processor = TemplateProcessor(tmpl)
 
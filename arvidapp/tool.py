@@ -0,0 +1,185 @@
+# ARVIDA C++ Preprocessor
+# Copyright (C) 2015-2019 German Research Center for Artificial Intelligence (DFKI)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Helpers shared by the arvidapp_gen, arvidapp_dump_ast and arvidapp_dump_ast_details command line tools"""
+
+from __future__ import absolute_import
+from builtins import object
+import sys
+import os
+import os.path
+import time
+import traceback
+import argparse
+import codecs
+import arvidapp
+
+# Files are written through a large buffer, dumps are written in many small pieces
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+
+def open_output(file_name):
+    """Returns UTF-8 writer to file_name, "-" writes to stdout"""
+    if file_name == "-":
+        stream = getattr(sys.stdout, 'buffer', sys.stdout)
+    else:
+        stream = open(file_name, "wb", OUTPUT_BUFFER_SIZE)
+    return codecs.getwriter('utf-8')(stream)
+
+
+def get_file_id(file_name):
+    """Returns (device, inode) of file_name, None when the file does not exist or has no inode number"""
+    try:
+        st = os.stat(file_name)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino) if st.st_ino else None
+
+
+class FileFilter(object):
+    """Cursor filter accepting cursors from the files selected on the command line"""
+
+    __slots__ = ('source_file_ids', '_fallback_real_paths', 'invocation_dir', 'all_headers', 'non_system_headers',
+                 '_invocation_prefix', '_decisions')
+
+    def __init__(self, source_files, invocation_dir, all_headers=False, non_system_headers=False):
+        # Files are identified by a single stat() call, real paths are only needed where there are no inodes
+        source_file_ids = set()
+        real_paths = set()
+        for source_file in source_files:
+            file_id = get_file_id(source_file)
+            if file_id is not None:
+                source_file_ids.add(file_id)
+            else:
+                real_paths.add(os.path.normcase(os.path.realpath(source_file)))
+        self.source_file_ids = frozenset(source_file_ids)
+        self._fallback_real_paths = frozenset(real_paths)  # source files without inode numbers
+        self.invocation_dir = invocation_dir
+        # Files below the invocation directory are not system headers
+        self._invocation_prefix = os.path.normcase(os.path.join(os.path.normpath(invocation_dir), ''))
+        self.all_headers = all_headers
+        self.non_system_headers = non_system_headers
+        self._decisions = {}  # file name --> result of should_process_file
+
+    def is_system_header(self, file_name):
+        return (os.path.isabs(file_name) and
+                not os.path.normcase(os.path.normpath(file_name)).startswith(self._invocation_prefix))
+
+    def is_source_file(self, file_name):
+        file_id = get_file_id(file_name)
+        if file_id is not None:
+            return file_id in self.source_file_ids
+        return os.path.normcase(os.path.realpath(file_name)) in self._fallback_real_paths
+
+    def should_process_file(self, filename):
+        if not filename:
+            return False
+
+        file_name = filename.name
+        result = self._decisions.get(file_name)
+        if result is None:
+            result = bool(self.all_headers or
+                          (self.non_system_headers and not self.is_system_header(file_name)) or
+                          self.is_source_file(file_name))
+            self._decisions[file_name] = result
+        return result
+
+    def __call__(self, cursor):
+        return self.should_process_file(cursor.location.file)
+
+
+def add_common_arguments(parser):
+    """Adds the options of all tools and the positional compiler command line to parser"""
+    parser.add_argument("-f", "-o", "--output", metavar="FILE",
+                        help='write dump to %(metavar)s;'
+                             ' "-" writes dump to stdout'
+                             ' (default: stdout)')
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="enable debugging output")
+    parser.add_argument("--version", action="version",
+                        version="%(prog)s 0.1")
+    parser.add_argument("--all-headers", action="store_true",
+                        help="write dump for all header files encountered "
+                             "(not just those specified on the command line)")
+    parser.add_argument("--non-system-headers", action="store_true",
+                        help="write dump for all non-system header files encountered")
+    parser.add_argument("--compile-commands", metavar="PATH",
+                        help="read compiler command line of the source file from compilation database %(metavar)s,"
+                             " either a compile_commands.json file or the directory containing it")
+    parser.add_argument("--ast-cache-dir", metavar="DIR",
+                        help="save parsed ASTs in %(metavar)s and reuse them while no parsed file changes")
+    parser.add_argument("args", nargs="*", help=argparse.SUPPRESS)
+
+
+def parse_args(parser, argv):
+    """Parses argv with parser, only options before the '--' separator are parsed,
+    the compiler command line is passed through as is"""
+    compiler_command_line = []
+    if '--' in argv:
+        separator_pos = argv.index('--')
+        compiler_command_line = argv[separator_pos + 1:]
+        argv = argv[:separator_pos]
+
+    args = parser.parse_args(argv)
+    args.args.extend(compiler_command_line)
+    if not args.args:
+        parser.error("no compiler command line given")
+    if not args.output:
+        args.output = "-"
+    if args.compile_commands:
+        try:
+            arvidapp.get_compilation_database_dir(args.compile_commands)
+        except ValueError as e:
+            parser.error(str(e))
+    args.source_files = args.args
+    args.compiler_command_line = args.args
+    return args
+
+
+def create_file_filter(args):
+    return FileFilter(args.source_files, os.getcwd(),
+                      all_headers=args.all_headers, non_system_headers=args.non_system_headers)
+
+
+def format_error_diagnostics(errors):
+    return ''.join(['%s:%i:%i: error: %s\n' % (d.location.file, d.location.line, d.location.column, d.spelling)
+                    for d in errors])
+
+
+def load_translation_unit(args, config_file_name, debug, error):
+    """Parses the compiler command line of args, reports failures with error(msg) which must not return"""
+    # Fail before libclang preprocesses anything
+    missing_files = arvidapp.get_missing_source_files(args.compiler_command_line)
+    if missing_files:
+        error("Source file '%s' does not exist" % missing_files[0])
+
+    try:
+        start = time.time()
+        trans_unit = arvidapp.build_translation_unit(config_file_name, args.compiler_command_line,
+                                                     cache_dir=args.ast_cache_dir,
+                                                     compile_commands=args.compile_commands)
+        debug("  clang parse took %.2fs" % (time.time() - start))
+    except Exception as e:
+        debug(traceback.format_exc())
+        error("Clang failed to parse '%s': %s" % (" ".join(args.compiler_command_line), e))
+
+    errors = arvidapp.get_error_diagnostics(trans_unit)
+    if errors:
+        # Written at once, stderr is unbuffered
+        sys.stderr.write(format_error_diagnostics(errors))
+        error("File '%s' failed clang's parsing and type-checking" % trans_unit.spelling)
+
+    return trans_unit
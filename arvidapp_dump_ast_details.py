@@ -20,17 +20,13 @@
 import sys
 import os
 import os.path
-import time
-import traceback
 import argparse
 
 import arvidapp
 import arvidapp.dump
-import clang.cindex
+import arvidapp.tool
 
 args = None
-source_files = []
-invocation_dir = None
 
 
 def debug(msg):
@@ -48,93 +44,36 @@ def error(msg):
     sys.exit(1)
 
 
-def should_process_file(filename, source_files):
-    global args
-
-    def is_system_header():
-        return (os.path.isabs(filename.name) and
-                os.path.relpath(filename.name, invocation_dir).startswith(".."))
-
-    return (filename and
-            (args.all_headers or
-             (args.non_system_headers and not is_system_header()) or
-             os.path.realpath(filename.name) in source_files))
-
-
 def main():
     global args
-    global source_files
-    global invocation_dir
 
     parser = argparse.ArgumentParser(
         description="Dump Clang AST details of C++ source code.",
         usage="\n%(prog)s [options] -- <compiler command line>"
               "\n%(prog)s [options] --compile-commands=<compile_commands.json>"
               " <source-file> ...")
-    parser.add_argument("-f", "-o", "--output", metavar="FILE",
-                        help='write dump to %(metavar)s;'
-                             ' "-" writes dump to stdout'
-                             ' (default: stdout)')
-    parser.add_argument("-v", "--verbose", action="store_true",
-                        help="enable debugging output")
-    parser.add_argument("--version", action="version",
-                        version="%(prog)s 0.1")
-    parser.add_argument("--all-headers", action="store_true",
-                        help="write dump for all header files encountered "
-                             "(not just those specified on the command line)")
-    parser.add_argument("--non-system-headers", action="store_true",
-                        help="write dump for all non-system header files encountered")
-    parser.add_argument("args", nargs="+", help=argparse.SUPPRESS)
-
-    args = parser.parse_args(sys.argv[1:])
-    if not args.output:
-        args.output = "-"
-    args.source_files = args.args
-    source_files = [os.path.realpath(x) for x in args.source_files]
-    args.compiler_command_line = args.args
-
-    invocation_dir = os.getcwd()
+    arvidapp.tool.add_common_arguments(parser)
+
+    args = arvidapp.tool.parse_args(parser, sys.argv[1:])
+
+    cursor_filter = arvidapp.tool.create_file_filter(args)
 
     tool_dir = os.path.dirname(os.path.realpath(__file__))
 
     config_filename = os.path.join(tool_dir, 'arvidapp.cfg')
 
-    try:
-        start = time.time()
-        trans_unit = arvidapp.build_translation_unit(config_filename, args.compiler_command_line)
-        debug("  clang parse took %.2fs" % (time.time() - start))
-    except Exception as exc:
-        debug(traceback.format_exc())
-        error("Clang failed to parse '%s': %s" % (" ".join(args.compiler_command_line), exc))
-
-    errors = [diag_err for diag_err in trans_unit.diagnostics
-              if diag_err.severity in (clang.cindex.Diagnostic.Error, clang.cindex.Diagnostic.Fatal)]
-
-    if errors:
-        for diag_err in errors:
-            sys.stderr.write('%s:%i:%i: error: %s' %
-                             (diag_err.location.file,
-                              diag_err.location.line,
-                              diag_err.location.column,
-                              diag_err.spelling))
-            sys.stderr.write('\n')
-        error("File '%s' failed clang's parsing and type-checking" % trans_unit.spelling)
-
-    if args.output == "-":
-        out = sys.stdout
-    else:
-        out = open(args.output, "wb")
+    trans_unit = arvidapp.tool.load_translation_unit(args, config_filename, debug, error)
+
+    out = arvidapp.tool.open_output(args.output)
 
     out.write(
         arvidapp.dump.dump_ast(
             trans_unit,
-            lambda cursor: should_process_file(cursor.location.file, source_files)))
+            cursor_filter))
     out.flush()
 
-    if out is not sys.stdout:
+    if args.output != "-":
         out.close()
-    else:
-        out.flush()
 
     return 0
 
@@ -39,8 +39,13 @@ from past.utils import old_div
 from builtins import object
 import os
 import os.path
+import re
 import shutil
+import zipfile
+import tarfile
 import datetime
+import functools
+import itertools
 import uuid
 import subprocess
 import json
@@ -51,15 +56,56 @@ from .flask_reverse_proxy import ReverseProxied
 from werkzeug.utils import secure_filename
 import mimetypes
 import logging
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    scandir = None
+try:
+    import orjson
+
+    def dump_json(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def dump_json(obj):
+        return json.dumps(obj)
 from logging.handlers import RotatingFileHandler
 from logging import Formatter
 
 mimetypes.init()
 
 
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# os.replace is not available in Python 2, os.rename replaces atomically on POSIX
+replace_file = getattr(os, 'replace', os.rename)
+
+
+# '..' as a path segment, normpath produces backslash separators on Windows
+_PARENT_DIR_SEGMENT_RE = re.compile(r'(?:^|[/\\])\.\.(?:[/\\]|$)')
+
+
+def write_file_atomically(path, write):
+    """Calls write(fd) on a temporary '<path>.part' file that is fsynced and moved to path, removed on errors"""
+    part_path = path + '.part'
+    try:
+        with open(part_path, mode='wb') as fd:
+            write(fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        replace_file(part_path, path)
+    except Exception:
+        # e.g. client disconnect or RequestEntityTooLarge while reading the upload
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+
+
 def my_secure_filename(path):
     path = os.path.normpath(path)
-    if '..' in path:
+    if _PARENT_DIR_SEGMENT_RE.search(path):
         return secure_filename(path)
     return path
 
@@ -106,15 +152,66 @@ class BadRequestError(Exception):
         super(BadRequestError, self).__init__(message)
 
 
+def iter_directory(path):
+    """Yield (name, path, is_directory, size) for each entry of the directory"""
+    if scandir is not None:
+        for dir_entry in scandir(path):
+            is_dir = dir_entry.is_dir(follow_symlinks=False)
+            size = 0
+            if not is_dir:
+                try:
+                    size = dir_entry.stat(follow_symlinks=False).st_size
+                except os.error:
+                    pass
+            yield dir_entry.name, dir_entry.path, is_dir, size
+    else:
+        for name in os.listdir(path):
+            fullpath = os.path.join(path, name)
+            is_dir = os.path.isdir(fullpath) and not os.path.islink(fullpath)
+            size = 0
+            if not is_dir:
+                try:
+                    size = os.lstat(fullpath).st_size
+                except os.error:
+                    pass
+            yield name, fullpath, is_dir, size
+
+
+_DISPLAY_INFO_CACHE = {}
+
+
+def get_display_info(ext):
+    """Returns (display_mode, highlight) for the file name extension"""
+    info = _DISPLAY_INFO_CACHE.get(ext)
+    if info is None:
+        # guess_type only looks at the last extension and compression suffixes
+        type, encoding = mimetypes.guess_type('file' + ext)
+        display_mode = 'text'
+        if type is not None and encoding is None:
+            if type.startswith('text/'):
+                display_mode = 'text'
+            elif type.startswith('image/'):
+                display_mode = 'image'
+        info = _DISPLAY_INFO_CACHE[ext] = (display_mode, EXTENSIONS.get(ext, None))
+    return info
+
+
 class FileEntry(object):
-    def __init__(self, task, name, fullpath, directory=False):
+    def __init__(self, task, name, fullpath, directory=False, size=None, parent=None, relpath=None):
         self.task = task
+        self.parent = parent
         self.name = name
         self.fullpath = fullpath
+        self.relpath = relpath if relpath is not None else task.relpath(fullpath)
         self.directory = directory
         self.children = []
+        self.ext = name[name.rfind('.'):] if '.' in name else ''
+        # (script root, json) - generated URLs depend on the script root set by ReverseProxied
+        self._json_cache = None
         if self.directory:
             self.size = 0
+        elif size is not None:
+            self.size = size
         else:
             try:
                 self.size = os.path.getsize(self.fullpath)
@@ -122,6 +219,10 @@ class FileEntry(object):
                 self.size = 0
 
     def to_json(self):
+        script_root = request.script_root
+        if self._json_cache is not None and self._json_cache[0] == script_root:
+            return self._json_cache[1]
+
         d = {'id': id(self), 'text': self.name, 'state': {'opened': False}}
         if self.directory:
             d['type'] = 'folder'
@@ -130,18 +231,9 @@ class FileEntry(object):
             d['type'] = 'file'
             d['children'] = False
 
-        type, encoding = mimetypes.guess_type(self.name)
-        highlight = None
-        display_mode = 'text'
-        if '.' in self.name:
-            highlight = EXTENSIONS.get(self.name[self.name.rfind('.'):], None)
-        if type is not None and encoding is None:
-            if type.startswith('text/'):
-                display_mode = 'text'
-            elif type.startswith('image/'):
-                display_mode = 'image'
+        display_mode, highlight = get_display_info(self.ext)
 
-        relpath = self.task.relpath(self.fullpath)
+        relpath = self.relpath
         task_id = self.task.get_str_id()
 
         d['data'] = {
@@ -153,6 +245,7 @@ class FileEntry(object):
             'highlight': highlight,
             'relpath': relpath
         }
+        self._json_cache = (script_root, d)
         return d
 
     def __repr__(self):
@@ -171,17 +264,47 @@ POPULATE_FILES = [
 ]
 
 
+def _is_safe_member_name(name):
+    return not os.path.isabs(name) and '..' not in name.replace('\\', '/').split('/')
+
+
+def _safe_tar_members(tf):
+    # Like GNU tar skip members with absolute paths or '..' components
+    for member in tf:
+        if not _is_safe_member_name(member.name):
+            continue
+        if (member.issym() or member.islnk()) and not _is_safe_member_name(member.linkname):
+            continue
+        yield member
+
+
+def extract_archive(path, dest_dir):
+    """Extract .zip and .tar.bz2 archives in-process, other files are ignored"""
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            zf.extractall(dest_dir)
+    elif path.endswith('.tar.bz2'):
+        with tarfile.open(path, 'r:bz2') as tf:
+            tf.extractall(dest_dir, members=_safe_tar_members(tf))
+
+
 # Classes
 class Task(object):
     def __init__(self, controller, load_from_dir=None):
         self.controller = controller
-        self.files = {}
-        self.ids = {}
+        # File tree is built on first access, see _load_files
+        self._files = {}
+        self._ids = {}
+        self._root = None
 
         if load_from_dir is not None:
             self.guid = uuid.UUID(os.path.basename(load_from_dir))
         else:
-            self.guid = uuid.uuid1()
+            # uuid4 does not need the host MAC address
+            self.guid = uuid.uuid4()
+        self._str_id = str(self.guid)
+        # upload_folder is absolute, see Controller
+        self._file_dir = os.path.join(controller.upload_folder, self.get_str_id())
 
         subst_vars = {
             'MODULE_DIR': os.path.dirname(__file__),
@@ -189,7 +312,7 @@ class Task(object):
         }
 
         for dest_file, src_file in POPULATE_FILES:
-            dest_path = os.path.abspath(os.path.join(self.file_dir, dest_file))
+            dest_path = self.abspath(dest_file)
             if not os.path.exists(dest_path):
                 dest_dir = os.path.dirname(dest_path)
                 if not os.path.exists(dest_dir):
@@ -198,8 +321,14 @@ class Task(object):
                 src_path = os.path.abspath(src_file.format(**subst_vars))
                 shutil.copyfile(src_path, dest_path)
 
-        self.update_files()
-        self.time = datetime.datetime.fromtimestamp(old_div((self.guid.time - 0x01b21dd213814000) * 100, 1e9))
+        if load_from_dir is None:
+            self.update_files()
+            self.time = datetime.datetime.now()
+        elif self.guid.version == 1:
+            # Tasks created with uuid1 carry their creation time
+            self.time = datetime.datetime.fromtimestamp(old_div((self.guid.time - 0x01b21dd213814000) * 100, 1e9))
+        else:
+            self.time = datetime.datetime.fromtimestamp(os.stat(self._file_dir).st_ctime)
         self.preprocess_result = None
         self.commandline = None
 
@@ -208,111 +337,135 @@ class Task(object):
         return ['sord', 'redland']
 
     def get_str_id(self):
-        return str(self.guid)
+        return self._str_id
+
+    def _load_files(self):
+        if self._root is None:
+            self.update_files()
+
+    @property
+    def files(self):
+        self._load_files()
+        return self._files
+
+    @property
+    def ids(self):
+        self._load_files()
+        return self._ids
+
+    @property
+    def root(self):
+        self._load_files()
+        return self._root
 
     @property
     def file_dir(self):
-        return os.path.abspath(os.path.join(self.controller.upload_folder, self.get_str_id()))
+        return self._file_dir
 
     def _get_directory_structure(self, root):
-        entry = FileEntry(self, name=os.path.basename(root), fullpath=root, directory=True)
-        self.ids[id(entry)] = entry
-        if os.path.exists(root):
-            for fname in os.listdir(root):
-                path = os.path.join(root, fname)
-                if os.path.isdir(path):
-                    child = self._get_directory_structure(path)
-                else:
-                    child = FileEntry(task=self, name=fname, fullpath=path)
-                self.files[path] = child
-                self.ids[id(child)] = child
+        root_entry = FileEntry(self, name=os.path.basename(root), fullpath=root, directory=True,
+                               relpath=self.relpath(root))
+        self._ids[id(root_entry)] = root_entry
+        if not os.path.exists(root):
+            return root_entry
+        stack = [root_entry]
+        while stack:
+            entry = stack.pop()
+            prefix = '' if entry is root_entry else entry.relpath + os.sep
+            for fname, path, is_dir, size in iter_directory(entry.fullpath):
+                child = FileEntry(task=self, name=fname, fullpath=path, directory=is_dir, size=size, parent=entry,
+                                  relpath=prefix + fname)
+                if is_dir:
+                    stack.append(child)
+                self._files[path] = child
+                self._ids[id(child)] = child
                 entry.children.append(child)
-        return entry
+        return root_entry
 
     def _remove_all(self, entry):
-        for child in entry.children:
-            self._remove_all(child)
-        try:
-            del self.files[entry.fullpath]
-            del self.ids[id(entry)]
-        except KeyError:
-            pass
-        if os.path.exists(entry.fullpath):
-            if os.path.isdir(entry.fullpath):
-                os.removedirs(entry.fullpath)
-            else:
-                os.remove(entry.fullpath)
-
-    def _remove_entry(self, root, entry):
-        if entry in root.children:
-            self._remove_all(entry)
-            root.children.remove(entry)
-            return True
-        for child in root.children:
-            if self._remove_entry(child, entry):
-                return True
-        return False
+        stack = [entry]
+        while stack:
+            e = stack.pop()
+            stack.extend(e.children)
+            self._files.pop(e.fullpath, None)
+            self._ids.pop(id(e), None)
+        if entry.directory:
+            shutil.rmtree(entry.fullpath, ignore_errors=True)
+        elif os.path.lexists(entry.fullpath):
+            os.remove(entry.fullpath)
+
+    def _remove_entry(self, entry):
+        if entry.parent is None:
+            return False
+        self._remove_all(entry)
+        entry.parent.children.remove(entry)
+        entry.parent = None
+        return True
 
     def update_files(self):
-        self.files.clear()
-        self.ids.clear()
-        self.root = self._get_directory_structure(self.file_dir)
+        self._files.clear()
+        self._ids.clear()
+        self._root = self._get_directory_structure(self._file_dir)
 
     def abspath(self, filename):
-        return os.path.abspath(os.path.join(self.file_dir, filename))
+        return os.path.normpath(os.path.join(self._file_dir, filename))
 
     def relpath(self, filename):
-        return os.path.relpath(filename, self.file_dir)
+        prefix = self._file_dir + os.sep
+        if filename.startswith(prefix):
+            return filename[len(prefix):]
+        return os.path.relpath(filename, self._file_dir)
 
     def remove_file_by_id(self, file_id):
         entry = self.ids.get(file_id, None)
         if entry is not None:
-            self._remove_entry(self.root, entry)
+            self._remove_entry(entry)
 
     def remove_file(self, filename):
         path = self.abspath(filename)
         entry = self.files.get(path, None)
         if entry is not None:
-            self._remove_entry(self.root, entry)
+            self._remove_entry(entry)
 
     def save_file(self, file, filename):
         path = self.abspath(filename)
         dir = os.path.dirname(path)
         if not os.path.exists(dir):
             os.makedirs(dir)
-        file.save(path)
+        write_file_atomically(path, lambda fd: file.save(fd, buffer_size=UPLOAD_CHUNK_SIZE))
         try:
-            if path.endswith('.zip'):
-                commandline = ['unzip', '-d', os.path.dirname(path), path]
-                result = run_command(commandline, cwd=self.file_dir)
-            elif path.endswith('.tar.bz2'):
-                commandline = ['tar', '-C', os.path.dirname(path), '-xvf', path]
-                result = run_command(commandline, cwd=self.file_dir)
+            extract_archive(path, dir)
         except Exception as e:
-            msg = 'Could not execute command line "%s" in directory "%s"' % (commandline, self.file_dir)
-            app.logger.exception(msg)
+            msg = 'Could not extract archive "%s" in directory "%s"' % (path, dir)
+            current_app.logger.exception(msg)
             flash(msg)
         self.update_files()
 
     def save_data(self, data, filename):
+        """Save data (bytes, readable stream or iterable of byte chunks) to the file,
+        streamed in chunks via a temporary .part file"""
         path = self.abspath(filename)
         dir = os.path.dirname(path)
         if not os.path.exists(dir):
             os.makedirs(dir)
-        fd = open(path, mode='wb')
-        fd.write(data)
-        fd.close()
+
+        def write(fd):
+            if isinstance(data, bytes):
+                fd.write(data)
+                return
+            if hasattr(data, 'read'):
+                chunks = iter(functools.partial(data.read, UPLOAD_CHUNK_SIZE), b'')
+            else:
+                chunks = data
+            for chunk in chunks:
+                fd.write(chunk)
+
+        write_file_atomically(path, write)
         # FIXME
         self.update_files()
 
     def remove_files(self):
-        task_dir = os.path.join(self.controller.upload_folder, self.get_str_id())
-        for root, dirs, files in os.walk(task_dir, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(task_dir)
+        shutil.rmtree(self._file_dir, ignore_errors=True)
         self.update_files()
 
     def remove(self):
@@ -325,12 +478,11 @@ class Controller(object):
         if not os.path.exists(upload_folder):
             os.makedirs(upload_folder)
         self.tasks = {}
-        self.upload_folder = upload_folder
+        self.upload_folder = os.path.abspath(upload_folder)
         self.arvidapp_include_dir = arvidapp_include_dir
         self.arvidapp_generator_path = arvidapp_generator_path
-        for name in os.listdir(self.upload_folder):
-            path = os.path.join(self.upload_folder, name)
-            if os.path.isdir(path):
+        for name, path, is_dir, size in iter_directory(self.upload_folder):
+            if is_dir:
                 task = Task(self, path)
                 self.tasks[task.get_str_id()] = task
 
@@ -394,11 +546,10 @@ def run_command(command, env=None, cwd=None):
                              cwd=cwd,
                              universal_newlines=False,
                              shell=True)
-    out = p.stdout.read()
-    p.stdout.close()
-    err = p.stderr.read()
-    p.stderr.close()
-    status = p.wait()
+    # communicate drains stdout and stderr concurrently, sequential reads deadlock
+    # when the child fills the stderr pipe before closing stdout
+    out, err = p.communicate()
+    status = p.returncode
 
     return status, out, err
 
@@ -409,7 +560,9 @@ CONFIG_KEYS = {
     'UPLOAD_FOLDER': 'Directory where uploaded files will be stored',
     'MAX_CONTENT_LENGTH': 'Maximum length of the file that can be uploaded',
     'ARVIDAPP_INCLUDE_DIR': 'Path to arvidapp include directory',
-    'ARVIDAPP_GENERATOR_PATH': 'Path to arvidapp_gen.py executable'
+    'ARVIDAPP_GENERATOR_PATH': 'Path to arvidapp_gen.py executable',
+    'USE_X_SENDFILE': 'Let the front-end web server send downloaded files via X-Sendfile header',
+    'SERVE_STATIC': 'Serve /static files from Flask, disable when the front-end web server serves them'
 }
 
 DEFAULT_LOG_FILE = 'arvidapp_web.log'
@@ -445,12 +598,28 @@ def create_app(config=None, init_logger=None):
         LOG_FILE=os.path.join(app.instance_path, DEFAULT_LOG_FILE),
         UPLOAD_FOLDER=os.path.join(app.instance_path, 'uploads'),
         MAX_CONTENT_LENGTH=100 * 1024 * 1024,  # Maximal 100 Mb for uploads
+        USE_X_SENDFILE=False,
+        SERVE_STATIC=True,
     )
     app.config.from_envvar('ARVIDAPP_WEB_SETTING', silent=True)
     if config is not None:
         # Update configuration from passed dictionary
         app.config.update(config)
 
+    # Values passed via --config-var are strings
+    for key in ('USE_X_SENDFILE', 'SERVE_STATIC'):
+        value = app.config.get(key)
+        if not isinstance(value, bool):
+            app.config[key] = str(value).lower() in ('1', 'true', 'yes', 'on')
+
+    if not app.config['SERVE_STATIC']:
+        # Static files are served by the front-end web server (see ReverseProxied),
+        # keep the 'static' endpoint only for url_for
+        def static_not_served(filename):
+            abort(HTTP_NOT_FOUND)
+
+        app.view_functions['static'] = static_not_served
+
     if init_logger is not None:
         init_logger(app)
 
@@ -539,11 +708,15 @@ def create_app(config=None, init_logger=None):
                 if file:
                     task.save_file(file, filename)
                     return filename
-                elif request.data:
-                    task.save_data(request.data, filename)
-                    return filename
-                else:
-                    abort(HTTP_BAD_REQUEST)  # Bad request
+                elif not request.form and not request.files:
+                    # Raw request body, chunked uploads have no Content-Length, so read ahead to detect empty bodies.
+                    # Form data bodies were already consumed by request.files
+                    chunks = iter(functools.partial(request.stream.read, UPLOAD_CHUNK_SIZE), b'')
+                    first_chunk = next(chunks, b'')
+                    if first_chunk:
+                        task.save_data(itertools.chain((first_chunk,), chunks), filename)
+                        return filename
+                abort(HTTP_BAD_REQUEST)  # Bad request
             abort(403)  # Forbidden
         elif request.method == 'DELETE':
             filename = my_secure_filename(filename or (file and file.filename))
@@ -551,7 +724,10 @@ def create_app(config=None, init_logger=None):
             return filename
         elif request.method == 'GET':
             filename = my_secure_filename(filename or (file and file.filename))
-            return send_from_directory(task.file_dir, filename, as_attachment=True, cache_timeout=-1)
+            # send_file streams through wsgi.file_wrapper (or X-Sendfile when USE_X_SENDFILE is set),
+            # conditional enables ETag/If-None-Match and Range handling
+            return send_from_directory(task.file_dir, filename, as_attachment=True, cache_timeout=-1,
+                                       conditional=True)
         abort(HTTP_BAD_REQUEST)  # Bad request
 
     @app.route("/tasks/<task_id>/jstree", methods=['GET'])
@@ -571,7 +747,7 @@ def create_app(config=None, init_logger=None):
         if node is None:
             node = task.root
 
-        result = json.dumps([n.to_json() for n in node.children])
+        result = dump_json([n.to_json() for n in node.children])
 
         return Response(result, mimetype='application/json')
 
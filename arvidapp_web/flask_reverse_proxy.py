@@ -36,6 +36,14 @@ class ReverseProxied(object):
         proxy_set_header X-Script-Name /prefix;
         }
 
+    Static files can be served by nginx directly when the application
+    is started with SERVE_STATIC=false:
+
+    location /prefix/static {
+        alias /path/to/arvidapp_web/static;
+        gzip_static on;
+        }
+
     :param app: the WSGI application
     """
 
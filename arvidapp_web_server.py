@@ -7,16 +7,26 @@ import atexit
 import logging
 import signal
 import sys
-import copy
+import threading
 from logging.handlers import RotatingFileHandler
 
-from arvidapp_web import create_app, CONFIG_KEYS, DEFAULT_LOG_FILE
+try:
+    from logging.handlers import QueueHandler, QueueListener
+    from queue import Queue
+except ImportError:
+    # Python 2, log files are written directly
+    QueueHandler = QueueListener = Queue = None
 
 # Init default console handler
 
 LOG_FORMAT = '%(asctime)s %(levelname)s %(pathname)s:%(lineno)s: %(message)s'
+log_formatter = logging.Formatter(LOG_FORMAT)
+# LOG_FORMAT does not use thread and process information, skip collecting it for every record
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+console_handler.setFormatter(log_formatter)
 root_logger = logging.getLogger()
 root_logger.setLevel(logging.WARNING)
 root_logger.addHandler(console_handler)
@@ -25,6 +35,42 @@ logger = logging.getLogger('main')
 logger.setLevel(logging.WARNING)
 
 
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that does not flush the file after every record.
+
+    Records of level WARNING and above are flushed immediately, all others
+    at the latest after flush_interval seconds.
+    """
+
+    def __init__(self, filename, flush_interval=1.0, **kwargs):
+        RotatingFileHandler.__init__(self, filename, **kwargs)
+        self._defer_flush = False
+        self._stop_flushing = threading.Event()
+        self._flush_thread = threading.Thread(target=self._flush_periodically, args=(flush_interval,))
+        self._flush_thread.daemon = True
+        self._flush_thread.start()
+
+    def _flush_periodically(self, interval):
+        while not self._stop_flushing.wait(interval):
+            self.flush()
+
+    def emit(self, record):
+        self._defer_flush = record.levelno < logging.WARNING
+        try:
+            RotatingFileHandler.emit(self, record)
+        finally:
+            self._defer_flush = False
+
+    def flush(self):
+        if not self._defer_flush:
+            RotatingFileHandler.flush(self)
+
+    def close(self):
+        self._stop_flushing.set()
+        RotatingFileHandler.close(self)
+
+
 def set_loggers_level(loggers, level):
     for i in loggers:
         if isinstance(i, logging.Logger):
@@ -52,81 +98,35 @@ def start_server(args, app):
 
     loop = IOLoop.current()
 
-    def stop_ioloop():
+    def stop_ioloop(signalnum):
+        print('Got signal {}, exiting'.format(signalnum), file=sys.stderr)
         logging.info('Stopping IOLoop')
         loop.stop()
 
-    def signal_term_handler(signalnum, frame):
-        print('Got signal {}, exiting'.format(signalnum), file=sys.stderr)
-        stop_ioloop()
-        sys.exit(0)
-
-    def on_exit():
-        pass
-
-    signal.signal(signal.SIGTERM, signal_term_handler)
-    signal.signal(signal.SIGINT, signal_term_handler)
-    atexit.register(on_exit)
+    # Handle signals on the IOLoop thread, not inside a Python signal handler
+    asyncio_loop = getattr(loop, 'asyncio_loop', None)
+    for signalnum in (signal.SIGTERM, signal.SIGINT):
+        if asyncio_loop is not None:
+            asyncio_loop.add_signal_handler(signalnum, stop_ioloop, signalnum)
+        else:
+            # Tornado without asyncio (Python 2)
+            signal.signal(signalnum, lambda signalnum, frame: loop.add_callback_from_signal(stop_ioloop, signalnum))
 
     loop.start()
 
 
 def main():
-    def ensure_value(namespace, name, value):
-        if getattr(namespace, name, None) is None:
-            setattr(namespace, name, value)
-        return getattr(namespace, name)
-
-    class AppendKeyValue(argparse.Action):
-
-        def __init__(self,
-                     option_strings,
-                     dest,
-                     nargs=None,
-                     const=None,
-                     default=None,
-                     type=None,
-                     choices=None,
-                     required=False,
-                     help=None,
-                     metavar=None):
-            if nargs == 0:
-                raise ValueError('nargs for append actions must be > 0; if arg '
-                                 'strings are not supplying the value to append, '
-                                 'the append const action may be more appropriate')
-            if const is not None and nargs != argparse.OPTIONAL:
-                raise ValueError('nargs must be %r to supply const' % argparse.OPTIONAL)
-            super(AppendKeyValue, self).__init__(
-                option_strings=option_strings,
-                dest=dest,
-                nargs=nargs,
-                const=const,
-                default=default,
-                type=type,
-                choices=choices,
-                required=required,
-                help=help,
-                metavar=metavar)
-
-        def __call__(self, parser, namespace, values, option_string=None):
-            kv = values.split('=', 1)
-            if len(kv) == 1:
-                kv.append('')
-
-            items = copy.copy(ensure_value(namespace, self.dest, []))
-            items.append(kv)
-            setattr(namespace, self.dest, items)
-
-    class StoreNameValuePair(argparse.Action):
-        def __call__(self, parser, namespace, values, option_string=None):
-            n, v = values.split('=')
-            setattr(namespace, n, v)
-
-    parser = argparse.ArgumentParser(
+    class ServerArgumentParser(argparse.ArgumentParser):
+        def format_help(self):
+            # arvidapp_web imports Flask, load it only when help is requested
+            from arvidapp_web import CONFIG_KEYS
+            self.epilog = "Available configuration variables:\n" + \
+                          "\n".join(["{}: {}".format(k, v) for k, v in CONFIG_KEYS.items()])
+            return super(ServerArgumentParser, self).format_help()
+
+    parser = ServerArgumentParser(
         description="ARVIDA Preprocessor Web Server",
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="Available configuration variables:\n" +
-               "\n".join(["{}: {}".format(k, v) for k, v in CONFIG_KEYS.items()])
+        formatter_class=argparse.RawDescriptionHelpFormatter
     )
     parser.add_argument("-d", "--debug", action="store_true",
                         help="enable debug mode")
@@ -134,7 +134,7 @@ def main():
                         help="output log to console", default=False)
     parser.add_argument("-l", "--log-file", nargs='?',
                         help="output log to file", metavar="FILE", type=str,
-                        const=DEFAULT_LOG_FILE,
+                        const=True,  # replaced by DEFAULT_LOG_FILE below
                         default=None)
     parser.add_argument("--log-max-bytes",
                         help="Rollover whenever the current log file is nearly MAX_BYTES in length",
@@ -144,23 +144,28 @@ def main():
                         help="If BACKUP_COUNT is non-zero, the system will save old log files by appending the "
                              "extensions '.1', '.2' etc., to the filename.",
                         metavar="BACKUP_COUNT", type=int,
-                        default=1024 * 1024 * 100)
+                        default=10)
     parser.add_argument("-p", "--port", default=DEFAULT_PORT,
                         help="listen on the given port", type=int)
     parser.add_argument("--host", default=DEFAULT_HOST,
                         help="listen on the given host")
-    parser.add_argument("--config-var", metavar="VAR=VALUE", action=AppendKeyValue,
+    parser.add_argument("--config-var", metavar="VAR=VALUE", action="append", default=[],
                         help="set configuration variable")
     parser.add_argument("--version", action="version",
                         version="%(prog)s 0.1")
 
     args = parser.parse_args(sys.argv[1:])
 
+    from arvidapp_web import create_app, DEFAULT_LOG_FILE
+
+    if args.log_file is True:
+        args.log_file = DEFAULT_LOG_FILE
+
     config = {}
 
-    if args.config_var:
-        for name, value in args.config_var:
-            config[name] = value
+    for name_value in args.config_var:
+        name, _, value = name_value.partition('=')
+        config[name] = value
 
     config_log_file = config.get('LOG_FILE', None)
 
@@ -192,15 +197,23 @@ def main():
             logdir = os.path.dirname(log_file)
             if logdir and not os.path.exists(logdir):
                 os.makedirs(logdir)
-            log_handler = RotatingFileHandler(log_file, maxBytes=args.log_max_bytes, backupCount=args.log_backup_count)
+            log_handler = BufferedRotatingFileHandler(log_file, maxBytes=args.log_max_bytes,
+                                                      backupCount=args.log_backup_count)
             if args.debug:
                 log_handler.setLevel(logging.DEBUG)
-            log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            log_handler.setFormatter(log_formatter)
+            if QueueHandler is not None:
+                # Write log file and rollover in a background thread
+                log_queue = Queue(-1)
+                listener = QueueListener(log_queue, log_handler, respect_handler_level=True)
+                listener.start()
+                atexit.register(listener.stop)
+                log_handler = QueueHandler(log_queue)
             root_logger.addHandler(log_handler)
-            app.logger.addHandler(log_handler)
 
-        if args.log_to_console:
-            app.logger.addHandler(console_handler)
+        # Application records reach the file and console handlers through the root logger,
+        # adding the handlers to app.logger too would emit every record twice
+        app.logger.propagate = True
 
         if args.debug:
             set_loggers_level((logger, app.logger), logging.DEBUG)